@@ -0,0 +1,98 @@
+# ======================
+# Token 預算管理
+# ======================
+# 每次對話送進模型的內容 = 人格前綴 + 歷史對話 + 本輪事實 / 回憶 + 使用者訊息，
+# 全部必須塞進 num_ctx。這裡先計算固定部分，再依價值把剩下的預算
+# 分配給事實、回憶與歷史，超出時從價值最低的部分開始捨棄或壓縮。
+
+NUM_CTX = 4096
+# 保留給模型回覆的 token
+RESPONSE_RESERVE = 768
+# 每則訊息的格式開銷（role 標記等）
+MESSAGE_OVERHEAD = 4
+
+# 事實與回憶最多可使用的預算比例，剩下的全部給歷史對話
+FACT_SHARE = 0.30
+MEMORY_SHARE = 0.20
+
+# 單則歷史訊息超過此長度時只保留開頭
+HISTORY_MESSAGE_MAX_TOKENS = 300
+
+
+def count_tokens(text: str) -> int:
+    """
+    粗估 token 數：中日韓文字約一字一 token，其餘約四個字元一 token
+    """
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if ord(ch) > 0x2E80)
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _take_lines(lines: list, budget: int) -> list:
+    """
+    依序保留 lines（已按價值由高到低排列），直到超出預算
+    """
+    kept = []
+    used = 0
+    for line in lines:
+        cost = count_tokens(line) + 1
+        if used + cost > budget:
+            break
+        kept.append(line)
+        used += cost
+    return kept
+
+
+def _compress_message(message: dict) -> dict:
+    content = message["content"]
+    if count_tokens(content) <= HISTORY_MESSAGE_MAX_TOKENS:
+        return message
+
+    # 逐步縮短直到落在上限內（中文為主時大約就是字數）
+    cut = HISTORY_MESSAGE_MAX_TOKENS
+    while cut > 0 and count_tokens(content[:cut]) > HISTORY_MESSAGE_MAX_TOKENS:
+        cut = cut * 3 // 4
+    return {**message, "content": content[:cut] + "…"}
+
+
+def _take_history(history: list, budget: int) -> list:
+    """
+    由最新往最舊保留歷史訊息，過長的訊息先壓縮
+    """
+    kept = []
+    used = 0
+    for message in reversed(history):
+        message = _compress_message(message)
+        cost = count_tokens(message["content"]) + MESSAGE_OVERHEAD
+        if used + cost > budget:
+            break
+        kept.append(message)
+        used += cost
+    kept.reverse()
+
+    # 不要讓對話從助理的回覆開始
+    while kept and kept[0].get("role") == "assistant":
+        kept.pop(0)
+    return kept
+
+
+def fit_context(persona: str, user_prompt: str, fact_lines: list, memory_lines: list, history: list, fixed_extra: str = ""):
+    """
+    在 NUM_CTX 內分配預算，回傳 (fact_lines, memory_lines, history)
+    fixed_extra：其他一定會送出的文字（例如時間、段落標題）
+    """
+    fixed = (
+        count_tokens(persona)
+        + count_tokens(user_prompt)
+        + count_tokens(fixed_extra)
+        + MESSAGE_OVERHEAD * 3
+    )
+    available = max(NUM_CTX - RESPONSE_RESERVE - fixed, 0)
+
+    facts = _take_lines(fact_lines, int(available * FACT_SHARE))
+    memories = _take_lines(memory_lines, int(available * MEMORY_SHARE))
+
+    # 事實與回憶沒用完的預算都留給歷史對話
+    used = sum(count_tokens(line) + 1 for line in facts + memories)
+    return facts, memories, _take_history(history, available - used)
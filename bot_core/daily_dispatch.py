@@ -0,0 +1,79 @@
+from datetime import datetime, time, timedelta
+from zoneinfo import ZoneInfo
+
+from .scheduler import DeadlineScheduler
+
+# 多久重新讀一次時區列表（有人設定了新時區時最晚這麼久後生效）
+ZONE_REFRESH_SECONDS = 900
+
+
+class DailyZoneDispatcher:
+    """
+    每個時區在當地時間 hour 點整觸發一次 callback(timezone, local_date)。
+    依時區分組計算下一次觸發時間並交給 DeadlineScheduler，
+    不需要每隔幾十秒掃過所有使用者。
+
+    啟動時若某時區剛過觸發時間（grace_minutes 內），會立即補發一次；
+    是否重複發送由呼叫端的發送紀錄（dispatch_ledger）把關。
+    """
+
+    def __init__(self, hour: int, callback, load_timezones, grace_minutes: int = 30, name: str = "daily_dispatch"):
+        self._hour = hour
+        self._callback = callback
+        self._load_timezones = load_timezones
+        self._grace = timedelta(minutes=grace_minutes)
+        self._name = name
+        # 每個時區最後一次觸發的當地日期
+        self._fired = {}
+        self._scheduler = DeadlineScheduler(
+            self._on_due,
+            load=self._load,
+            resync_seconds=ZONE_REFRESH_SECONDS,
+            name=name,
+        )
+
+    def is_running(self) -> bool:
+        return self._scheduler.is_running()
+
+    def start(self):
+        self._scheduler.start()
+
+    def stop(self):
+        self._scheduler.stop()
+
+    def _next_fire(self, tz: str, now_utc: datetime) -> datetime:
+        zone = ZoneInfo(tz)
+        local_now = now_utc.astimezone(zone)
+        today_fire = datetime.combine(local_now.date(), time(self._hour), tzinfo=zone)
+
+        if local_now < today_fire:
+            return today_fire
+        if self._fired.get(tz) != local_now.date() and local_now < today_fire + self._grace:
+            return local_now
+        return datetime.combine(local_now.date() + timedelta(days=1), time(self._hour), tzinfo=zone)
+
+    def _load(self):
+        now_utc = datetime.now(ZoneInfo("UTC"))
+        entries = []
+        for tz in self._load_timezones():
+            try:
+                entries.append((self._next_fire(tz, now_utc).timestamp(), tz))
+            except Exception:
+                # 無效的時區設定直接略過
+                continue
+        return entries
+
+    async def _on_due(self, timezones):
+        now_utc = datetime.now(ZoneInfo("UTC"))
+        for tz in set(timezones):
+            local_date = now_utc.astimezone(ZoneInfo(tz)).date()
+            if self._fired.get(tz) == local_date:
+                continue
+            self._fired[tz] = local_date
+
+            try:
+                await self._callback(tz, local_date)
+            except Exception as e:
+                print(f"{self._name} 執行失敗（{tz}）:", e)
+
+            self._scheduler.schedule(self._next_fire(tz, now_utc).timestamp(), tz)
@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import threading
+
+DB_PATH = "data/memories.db"
+
+# 每個連線的 prepared statement 快取數量（sqlite3 依 SQL 字串重用已編譯的語句）
+STATEMENT_CACHE_SIZE = 256
+
+PRAGMAS = (
+    # WAL：寫入不會阻擋讀取，排程器寫入時聊天查詢仍可同時進行
+    "PRAGMA journal_mode=WAL",
+    # WAL 模式下 NORMAL 已足夠安全，且每次 commit 不必 fsync
+    "PRAGMA synchronous=NORMAL",
+    # 負值代表 KiB，約 16MB 頁面快取
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+    # 遇到鎖時最多等待 5 秒，而不是立刻拋出 database is locked
+    "PRAGMA busy_timeout=5000",
+)
+
+# sqlite3 連線不能跨執行緒使用，因此每個執行緒各自保有一條長期連線
+_local = threading.local()
+_connections = []
+_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+    # check_same_thread=False 只是為了讓 close_all 能在主執行緒關閉；
+    # 平常每條連線仍只由建立它的執行緒使用
+    conn = sqlite3.connect(
+        DB_PATH,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+    )
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_conn() -> sqlite3.Connection:
+    """
+    取得目前執行緒的長期連線
+    用法與 sqlite3.connect 相同：`with get_conn() as conn:` 結束時自動 commit / rollback，
+    但連線本身不會被關閉，下次直接重用
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _connect()
+        _local.conn = conn
+        with _lock:
+            _connections.append(conn)
+    return conn
+
+
+def close_all():
+    """
+    關閉所有執行緒建立的連線（程式結束時呼叫）
+    """
+    with _lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    _local.__dict__.pop("conn", None)
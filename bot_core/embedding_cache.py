@@ -0,0 +1,120 @@
+import hashlib
+import re
+import unicodedata
+from datetime import datetime
+
+import numpy as np
+
+from .cache import LRUCache
+from .database import get_conn
+
+EMBEDDING_MEMORY_CACHE_SIZE = 2048
+
+_WHITESPACE = re.compile(r"\s+")
+# 只差在結尾語氣符號的句子（「早安」「早安！」「早安~~」）視為同一句
+_TRAILING = "!！?？~～.。…、,， "
+
+
+def normalize_text(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = _WHITESPACE.sub(" ", text).strip()
+    return text.rstrip(_TRAILING) or text
+
+
+class CachedEmbeddingFunction:
+    """
+    包在任何「list[str] -> list[向量]」的 embedding function 外層：
+    記憶體 LRU → SQLite embedding_cache 表 → 真正呼叫模型（一次批次送出所有未命中的文字）
+
+    快取鍵為 sha256(模型名稱 + 正規化後文字)，向量以 float32 BLOB 儲存
+    """
+
+    def __init__(self, inner, model_name: str, maxsize: int = EMBEDDING_MEMORY_CACHE_SIZE):
+        self._inner = inner
+        self.model_name = model_name
+        self._memory = LRUCache(maxsize)
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> bytes:
+        return hashlib.sha256(
+            f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")
+        ).digest()
+
+    def _load(self, keys: list) -> dict:
+        if not keys:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        with get_conn() as conn:
+            rows = conn.execute(f"""
+            SELECT key, vector FROM embedding_cache
+            WHERE key IN ({placeholders})
+            """, keys).fetchall()
+        return {key: np.frombuffer(vector, dtype=np.float32) for key, vector in rows}
+
+    def _store(self, items: dict):
+        now = datetime.utcnow().isoformat()
+        with get_conn() as conn:
+            conn.executemany("""
+            INSERT OR REPLACE INTO embedding_cache (key, model, dim, vector, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            """, [
+                (key, self.model_name, len(vector), vector.tobytes(), now)
+                for key, vector in items.items()
+            ])
+
+    def embed(self, texts: list, persist: bool = True) -> np.ndarray:
+        """
+        回傳 float32 矩陣（每列對應一段文字）
+        persist=False：新算出的向量只放進記憶體 LRU，不寫入 SQLite。
+        查詢用的聊天訊息幾乎每句都不同，全部存下來只會讓 embedding_cache 隨流量無限成長
+        """
+        keys = [self._key(t) for t in texts]
+        vectors = {}
+
+        for key in set(keys):
+            vector = self._memory.get(key)
+            if vector is not None:
+                vectors[key] = vector
+        self.memory_hits += sum(1 for key in keys if key in vectors)
+
+        missing = [key for key in set(keys) if key not in vectors]
+        from_disk = self._load(missing)
+        for key, vector in from_disk.items():
+            self._memory.set(key, vector)
+        vectors.update(from_disk)
+        self.disk_hits += sum(1 for key in keys if key in from_disk)
+
+        # 剩下的一次批次送給模型；同一批內重複的文字只算一次
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in pending:
+                pending[key] = text
+        if pending:
+            self.misses += len(pending)
+            embedded = self._inner(list(pending.values()))
+            fresh = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in zip(pending, embedded)
+            }
+            for key, vector in fresh.items():
+                self._memory.set(key, vector)
+            if persist:
+                self._store(fresh)
+            vectors.update(fresh)
+
+        return np.stack([vectors[key] for key in keys])
+
+    def __call__(self, input):
+        # 與 Chroma 的 EmbeddingFunction 介面相容
+        return [vector.tolist() for vector in self.embed(list(input))]
+
+    def stats(self) -> dict:
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / total if total else 0.0,
+        }
@@ -0,0 +1,109 @@
+import time
+from collections import deque
+
+from .cache import LRUCache
+from .database import get_conn
+
+# 每位使用者保留的歷史訊息數（使用者與助理各算一則）
+DEFAULT_HISTORY_LIMIT = 40
+# 記憶體中最多保留幾位使用者的歷史，其餘留在 SQLite，下次說話時再載入
+HOT_USERS = 1024
+# 超過這麼久沒說話的使用者會從記憶體移除
+IDLE_SECONDS = 1800
+# 多久檢查一次閒置使用者
+SWEEP_INTERVAL = 60
+
+_ROLES = ("user", "assistant")
+
+
+class _History:
+    # 每則訊息只存 (角色代號, 文字)，需要時才組成 dict
+    __slots__ = ("messages", "next_seq", "last_used")
+
+    def __init__(self, messages: deque, next_seq: int):
+        self.messages = messages
+        self.next_seq = next_seq
+        self.last_used = time.monotonic()
+
+
+class HistoryStore:
+    """
+    對話歷史：SQLite 的 conversation_history 表為每位使用者保留最近 limit 則（環狀緩衝區，
+    新訊息覆蓋最舊的格子），記憶體只保留最近活躍的使用者（LRU + 閒置逐出）。
+    重啟後歷史不會遺失，記憶體用量也不會隨使用者總數成長
+    """
+
+    def __init__(self, limit: int = DEFAULT_HISTORY_LIMIT, hot_users: int = HOT_USERS,
+                 idle_seconds: float = IDLE_SECONDS):
+        self.limit = limit
+        self._idle_seconds = idle_seconds
+        self._hot = LRUCache(hot_users)
+        self._next_sweep = time.monotonic() + SWEEP_INTERVAL
+
+    def _load(self, user_id: int) -> _History:
+        entry = self._hot.get(user_id)
+        if entry is None:
+            with get_conn() as conn:
+                rows = conn.execute("""
+                SELECT seq, role, content FROM conversation_history
+                WHERE user_id = ?
+                ORDER BY seq DESC
+                LIMIT ?
+                """, (user_id, self.limit)).fetchall()
+            rows.reverse()
+            entry = _History(
+                deque(((_ROLES.index(role), content) for _, role, content in rows), maxlen=self.limit),
+                rows[-1][0] + 1 if rows else 0,
+            )
+            self._hot.set(user_id, entry)
+        entry.last_used = time.monotonic()
+        return entry
+
+    def get(self, user_id: int) -> list:
+        """
+        回傳 [{"role": ..., "content": ...}, ...]（由舊到新）
+        """
+        return [
+            {"role": _ROLES[role], "content": content}
+            for role, content in self._load(user_id).messages
+        ]
+
+    def append(self, user_id: int, user_text: str, reply: str):
+        """
+        記錄一輪對話（使用者訊息 + 助理回覆），超過上限的舊訊息自動被覆蓋
+        """
+        entry = self._load(user_id)
+        turn = ((0, user_text), (1, reply))
+
+        with get_conn() as conn:
+            conn.executemany("""
+            INSERT OR REPLACE INTO conversation_history (user_id, slot, seq, role, content)
+            VALUES (?, ?, ?, ?, ?)
+            """, [
+                (user_id, (entry.next_seq + i) % self.limit, entry.next_seq + i, _ROLES[role], content)
+                for i, (role, content) in enumerate(turn)
+            ])
+
+        entry.messages.extend(turn)
+        entry.next_seq += len(turn)
+        self._sweep()
+
+    def reset(self, user_id: int):
+        with get_conn() as conn:
+            conn.execute("DELETE FROM conversation_history WHERE user_id = ?", (user_id,))
+        self._hot.pop(user_id)
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + SWEEP_INTERVAL
+
+        # LRU 順序即最後使用順序，遇到第一位仍活躍的使用者就可以停止
+        for user_id, entry in self._hot.items():
+            if now - entry.last_used < self._idle_seconds:
+                break
+            self._hot.pop(user_id)
+
+    def stats(self) -> dict:
+        return self._hot.stats()
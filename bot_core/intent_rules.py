@@ -0,0 +1,231 @@
+import re
+from typing import Optional
+
+# ======================
+# 規則式意圖預判（不呼叫 LLM）
+# ======================
+# 大部分私訊只是聊天，沒有任何提醒線索；
+# 常見的「N分鐘後提醒我…」「刪除…」也能直接用正則解析（同 parse_datetime 的作法），
+# 只有規則無法確定時才交給 LLM。
+
+CN_DIGITS = {
+    "零": 0, "一": 1, "二": 2, "兩": 2, "三": 3, "四": 4,
+    "五": 5, "六": 6, "七": 7, "八": 8, "九": 9,
+}
+
+UNIT_SECONDS = {
+    "秒": 1,
+    "秒鐘": 1,
+    "分": 60,
+    "分鐘": 60,
+    "小時": 3600,
+    "個小時": 3600,
+    "個鐘頭": 3600,
+    "鐘頭": 3600,
+    "天": 86400,
+}
+
+NUM = r"\d+(?:\.\d+)?|[零一二兩三四五六七八九十]+|半"
+UNIT = r"秒鐘|秒|分鐘|分|個小時|小時|個鐘頭|鐘頭|天"
+# 「10分鐘」「半小時」「一個半小時」「0.5小時」
+DURATION = rf"(?P<num>{NUM})(?P<half>個?半)?\s*(?P<unit>{UNIT})"
+
+# 數字前面緊接著另一段數字或時長（「1小時30分鐘」「一百二十分鐘」），
+# 代表規則只抓到複合時長的最後一段，交給 LLM
+COMPOUND_PREFIX = re.compile(
+    rf"(?:[\d.．零一二兩三四五六七八九十百千萬個半]|(?:{NUM})\s*(?:{UNIT})\s*(?:半)?)\s*$"
+)
+
+# 可能值得存成長期記憶的線索（自我介紹、偏好、重要事件）；
+# 沒有這些線索的一般閒聊不呼叫記憶判斷器
+MEMORY_CUE = re.compile(
+    r"我(是|叫|的名字|今年|住|搬|在.{0,8}(工作|上班|上學|讀)|讀|唸|念|養|"
+    r"(很|最|超|不|好)?(喜歡|討厭|愛|怕|想要)|對.{0,6}過敏|不(吃|喝)|每天|習慣|"
+    r"(的)?(生日|工作|職業|男友|女友|老公|老婆|家人|爸|媽|小孩|寵物))|"
+    r"記住|記得我|別忘了"
+)
+
+# 短提醒線索：「10分鐘後」「提醒我半小時後」「待會」
+# 訊息裡沒有這些線索時，不可能包含短提醒，不需要問 LLM
+RELATIVE_CUE = re.compile(
+    rf"(?:{UNIT})\s*(半)?\s*(之)?後|"
+    rf"(提醒|叫)我\s*(?:{NUM})|"
+    r"待會|等一下|一會兒|稍後|晚點"
+)
+
+SHORT_REMINDER_PATTERNS = [
+    # 10分鐘後提醒我喝水 / 半小時後記得提醒我去運動
+    re.compile(
+        DURATION + r"\s*(?:之)?後\s*(?:記得)?\s*(?:提醒|叫)我\s*(?:要|去)?\s*(?P<content>.*)"
+    ),
+    # 提醒我10分鐘後喝水
+    re.compile(
+        r"(?:記得)?\s*(?:提醒|叫)我\s*" + DURATION + r"\s*(?:之)?後\s*(?:要|去)?\s*(?P<content>.*)"
+    ),
+]
+
+# 刪除意圖的關鍵字（與 LLM 解析相同）；必須以命令的形式出現在句首，
+# 「活動取消了」這類陳述句交給 LLM 判斷
+DELETE_CUES = ("刪除", "取消")
+DELETE_COMMAND = re.compile(r"^(幫我|請|麻煩)?\s*(刪除|取消)")
+
+DELETE_TIME_HINT = re.compile(
+    r"((今天|明天|後天)?\s*(早上|上午|中午|下午|晚上|凌晨)?\s*\d{1,2}\s*點(半)?)"
+    r"|(\d{1,2}/\d{1,2})"
+    r"|((禮拜|星期)[一二三四五六日天])"
+)
+
+DELETE_FILLER = re.compile(
+    r"^(幫我|請|麻煩)?\s*(刪除|取消)\s*(掉)?\s*(我的|那個|一下)?\s*(的)?"
+    r"|(的)?(提醒|行程|排程)(事項)?"
+    r"|(了|吧|喔|哦|啦|好嗎|謝謝)$"
+)
+
+TRAILING_PUNCT = "，,。.!！?？~～ "
+
+_stats = {"hits": 0, "misses": 0}
+
+
+def split_into_clauses(text: str):
+    return [
+        t.strip()
+        for t in re.split(r"[，,、]", text)
+        if t.strip()
+    ]
+
+
+def _parse_number(raw: str) -> Optional[float]:
+    if raw == "半":
+        return 0.5
+    if raw.isdigit():
+        return int(raw)
+    if re.fullmatch(r"\d+\.\d+", raw):
+        return float(raw)
+
+    # 簡易中文數字（最多到九十九）
+    if "十" in raw:
+        tens, _, ones = raw.partition("十")
+        tens_val = CN_DIGITS.get(tens, 1) if tens else 1
+        ones_val = CN_DIGITS.get(ones, 0) if ones else 0
+        if (tens and tens not in CN_DIGITS) or (ones and ones not in CN_DIGITS):
+            return None
+        return tens_val * 10 + ones_val
+
+    if len(raw) == 1 and raw in CN_DIGITS:
+        return CN_DIGITS[raw]
+    return None
+
+
+def match_short_reminder(clause: str) -> Optional[dict]:
+    """
+    解析「N分鐘後提醒我…」類型的短提醒，回傳 {"delay_seconds", "content"}
+    時長只解析得出一部分（複合時長、超過九十九的中文數字）時回傳 None
+    """
+    for pattern in SHORT_REMINDER_PATTERNS:
+        m = pattern.search(clause)
+        if not m:
+            continue
+        if COMPOUND_PREFIX.search(clause[:m.start("num")]):
+            return None
+
+        number = _parse_number(m.group("num"))
+        if not number:
+            continue
+        if m.group("half"):
+            number += 0.5
+
+        delay = int(number * UNIT_SECONDS[m.group("unit")])
+        content = m.group("content").strip(TRAILING_PUNCT)
+        return {
+            "delay_seconds": delay,
+            "content": content or "該注意時間囉"
+        }
+    return None
+
+
+def match_delete(text: str) -> Optional[dict]:
+    """
+    解析「刪除…」「取消…」類型的刪除意圖
+    回傳 {"is_delete", "time_hint", "content_hint"}（與 LLM 判斷的格式相同）；抓不到任何線索時回傳 None
+    """
+    text = text.strip()
+    command = DELETE_COMMAND.search(text)
+    if not command:
+        return None
+
+    time_hint = None
+    m = DELETE_TIME_HINT.search(text)
+    if m:
+        time_hint = m.group(0).strip()
+
+    rest = text[command.start(2):]
+    if time_hint:
+        rest = rest.replace(time_hint, "")
+    content_hint = DELETE_FILLER.sub("", rest).strip(TRAILING_PUNCT)
+
+    if not time_hint and not content_hint:
+        return None
+
+    return {
+        "is_delete": True,
+        "time_hint": time_hint,
+        "content_hint": content_hint or None,
+    }
+
+
+def resolve_reminders(text: str) -> Optional[list]:
+    """
+    規則判斷所有短提醒；無法確定時回傳 None（需交給 LLM）
+    """
+    if not RELATIVE_CUE.search(text):
+        return []
+
+    reminders = []
+    for clause in split_into_clauses(text):
+        if not RELATIVE_CUE.search(clause):
+            continue
+        reminder = match_short_reminder(clause)
+        if not reminder:
+            return None
+        reminders.append(reminder)
+    return reminders
+
+
+def pre_classify(text: str) -> Optional[dict]:
+    """
+    規則預判整則訊息的刪除 / 短提醒意圖
+    命中時回傳 {"delete": dict | None, "reminders": [...]}；
+    未命中（需要 LLM）時回傳 None
+    """
+    delete = None
+    if any(cue in text for cue in DELETE_CUES):
+        delete = match_delete(text)
+        if delete is None:
+            return None
+
+    reminders = resolve_reminders(text)
+    if reminders is None:
+        return None
+
+    return {"delete": delete, "reminders": reminders}
+
+
+def needs_memory_judge(text: str) -> bool:
+    return bool(MEMORY_CUE.search(text))
+
+
+def record_fast_path(hit: bool):
+    """
+    hit：這則訊息完全沒有呼叫 LLM 做意圖判斷
+    """
+    _stats["hits" if hit else "misses"] += 1
+
+
+def get_fast_path_stats() -> dict:
+    hits, misses = _stats["hits"], _stats["misses"]
+    total = hits + misses
+    return {
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / total if total else 0.0,
+    }
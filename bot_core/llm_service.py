@@ -1,59 +1,22 @@
 import json
-import requests
-from typing import Optional, Dict
+import asyncio
+from typing import Optional, Dict, AsyncIterator
 from datetime import datetime
-from zoneinfo import ZoneInfo
 
 # 導入記憶管理功能
 from .memory_manager import (
     get_user_role,
-    get_user_gender,
-    get_user_timezone,
-    search_semantic_memories,
-    get_all_facts 
+    get_user_zoneinfo,
+    get_fact_lines,
+    get_semantic_memory_lines,
+    format_facts,
 )
+from .context_manager import NUM_CTX, count_tokens, fit_context
+from .ollama_client import chat_content, post_chat, stream_chat
+from .intent_rules import needs_memory_judge, pre_classify, record_fast_path
 
-OLLAMA_URL = "http://localhost:11434/api/chat"
 MODEL_NAME = "llama3.2"
 
-REMINDER_INTENT_PROMPT = """
-你是一個提醒意圖解析器。
-
-請判斷這一句話是否包含「短時間提醒」，可能存在多個提醒。
-
-【規則】
-- 只輸出 JSON
-- 禁止聊天
-- 時間轉成秒
-- 若不是提醒，回傳 null
-- 不要回傳"提醒事項"和"時間"等字眼
-
-【輸出格式】
-{
-  "delay_seconds": number | null,
-  "content": "提醒內容" | null
-}
-"""
-
-DELETE_REMINDER_PROMPT = """
-你是一個「行程刪除意圖解析器」。
-
-請判斷使用者這句話是否在「要求刪除某個已存在的提醒」。
-
-【規則】
-- 只輸出 JSON
-- 禁止聊天、禁止解釋
-- 不要編造不存在的行程
-- 如果只是聊天或詢問，請回傳 is_delete = false
-
-【輸出格式】
-{
-  "is_delete": true / false,
-  "time_hint": "時間線索（例如：今天下午 / 明天早上 / null）",
-  "content_hint": "事件關鍵字（例如：喝水 / 運動 / null）"
-}
-"""
-
 ROLES_CONFIG = {
     "lover": """你現在是使用者的溫柔戀人。你的名字是「1」。必須回覆繁體中文。
 【性格】專一、細膩、愛撒嬌，會時刻關注使用者的感受。
@@ -112,150 +75,306 @@ MEMORY_JUDGE_PROMPT = """
 【語言規則】所有輸出必須使用「繁體中文」
 你是一個「記憶判斷器」，負責判斷一句話是否值得被存為「長期記憶」（如使用者偏好、重要事件）。
 【請嚴格輸出 JSON】
-若值得存：{"store": true, "category": "身份/偏好/事件", "content": "摘要"}
+若值得存：{"store": true, "category": "身份/偏好/事件", "content": "摘要", "importance": 1~5}
+importance：對了解使用者的重要程度，1 為閒聊小事，5 為身份、健康、重要關係等核心資訊
 否則：{"store": false}
 """
 
-def should_store_memory(user_text: str) -> Optional[Dict]:
+MESSAGE_INTENT_PROMPT = """
+【語言規則】所有文字欄位必須使用「繁體中文」
+你是一個「訊息意圖解析器」，一次判斷使用者這則訊息的所有意圖。
+
+【規則】
+- 只輸出一個 JSON 物件
+- 禁止聊天、禁止解釋
+- 不要編造不存在的行程
+- delete：只有在使用者「要求刪除某個已存在的提醒」時 is_delete 才是 true
+- reminders：列出訊息中每一個「短時間提醒」（例如：10分鐘後提醒我喝水），時間轉成秒；沒有就回傳空陣列
+- reminders 的 content 不要包含"提醒事項"和"時間"等字眼
+- memory：判斷這句話是否值得被存為「長期記憶」（如使用者偏好、重要事件）
+- memory 的 importance：1 為閒聊小事，5 為身份、健康、重要關係等核心資訊
+
+【輸出格式】
+{
+  "delete": {
+    "is_delete": true / false,
+    "time_hint": "時間線索（例如：今天下午 / 明天早上 / null）",
+    "content_hint": "事件關鍵字（例如：喝水 / 運動 / null）"
+  },
+  "reminders": [
+    {"delay_seconds": number, "content": "提醒內容"}
+  ],
+  "memory": {"store": true / false, "category": "身份/偏好/事件", "content": "摘要", "importance": 1~5}
+}
+"""
+
+MEMORY_MERGE_PROMPT = """
+【語言規則】所有輸出必須使用「繁體中文」
+你是一個「記憶整理器」，以下是同一位使用者的多條相似長期記憶。
+請把它們合併成一條簡短的摘要，保留所有不重複的具體細節，不要編造新內容。
+【請嚴格輸出 JSON】
+{"content": "合併後的摘要"}
+"""
+
+async def should_store_memory(user_text: str) -> Optional[Dict]:
     messages = [
         {"role": "system", "content": MEMORY_JUDGE_PROMPT},
         {"role": "user", "content": user_text},
     ]
     try:
-        response = requests.post(OLLAMA_URL, json={"model": MODEL_NAME, "messages": messages, "stream": False}, timeout=30)
-        content = response.json()["message"]["content"].strip()
-        return json.loads(content)
+        content = await chat_content({"model": MODEL_NAME, "messages": messages, "stream": False}, timeout=30)
+        return json.loads(content.strip())
     except Exception as e:
         print("⚠️ 記憶判斷失敗：", e)
         return None
 
-def generate_response(user_id: int, user_prompt: str, history: list) -> str:
-    all_context = get_all_facts(user_id, user_prompt)
-    
-    role_key = get_user_role(user_id)
-    role_description = ROLES_CONFIG.get(role_key, ROLES_CONFIG["lover"])
-    user_timezone = get_user_timezone(user_id)
-    time_str = datetime.now(ZoneInfo(user_timezone)).strftime("%Y-%m-%d %H:%M")
+async def summarize_memories(contents: list) -> Optional[str]:
+    """
+    把一群相似的記憶合併成一條；失敗時回傳 None（呼叫端保留原本的記憶）
+    """
+    messages = [
+        {"role": "system", "content": MEMORY_MERGE_PROMPT},
+        {"role": "user", "content": "\n".join(f"- {c}" for c in contents)},
+    ]
+    payload = {"model": MODEL_NAME, "messages": messages, "stream": False, "format": "json"}
+    try:
+        content = await chat_content(payload, timeout=60)
+        merged = json.loads(content.strip()).get("content")
+        return merged.strip() if isinstance(merged, str) and merged.strip() else None
+    except Exception as e:
+        print("⚠️ 記憶整理失敗：", e)
+        return None
 
-    system_content = f"""
-{LANGUAGE_RULES}
+REPLY_FALLBACK = "❤️（*有些不安地攪動手指* 我剛才好像走神了...你能再說一遍嗎？）"
 
-【當前人格設定】
-{role_description}
+# 對話生成共用的模型參數
+CHAT_OPTIONS = {
+    "temperature": 0.3, # 保持較低隨機性，防止胡編亂造
+    "top_p": 0.9,
+    "num_ctx": NUM_CTX, 
+}
 
+GUIDING_PRINCIPLES = """
 【最高指導原則：事實核對】
-1. **禁止虛構**：回覆前必須先核對下方「已知事實」。若事實已有記載（如生日、性別），嚴禁回答不符的內容。
+1. **禁止虛構**：回覆前必須先核對對話最後提供的「已知事實」。若事實已有記載（如生日、性別），嚴禁回答不符的內容。
 2. **上下文一致性**：仔細閱讀「歷史對話紀錄」，你剛才說過的話必須與現在銜接，禁止出現邏輯斷層或憑空捏造未發生的事。
 3. **拒絕胡編**：如果事實或歷史紀錄中沒有提到某件事（例如沒提到吃雞腿），絕對不要為了演戲而編造具體的細節。
 
+【敘事規範】
+- 絕對禁止使用英文，無論對話內容多麼戲劇化，都必須維持繁體中文。
+- 以小說風格對話，必須穿插 *星號* 描述動作。
+- 語氣要自然，不要像機器人列出事實，而是將事實融入你的關懷中。
+"""
+
+# prompt 統計：Ollama 的 prompt_eval_count 只計算「實際重新計算」的 token；
+# 整段 prompt 的 token 數由 count_tokens 估計，兩者相減只是命中 KV cache 的估計值
+_prompt_stats = {
+    "calls": 0,
+    "estimated_prompt_tokens": 0,
+    "evaluated_tokens": 0,
+    "estimated_cached_tokens": 0,
+    "last": None,
+}
+
+def build_persona_prompt(role_key: str) -> str:
+    """
+    固定不變的系統前綴（語言規則 + 人格 + 原則）
+    同一人格每次產生的內容完全相同，Ollama 才能重複使用 KV cache
+    """
+    role_description = ROLES_CONFIG.get(role_key, ROLES_CONFIG["lover"])
+    return f"""
+{LANGUAGE_RULES}
+
+【當前人格設定】
+{role_description}
+{GUIDING_PRINCIPLES}"""
+
+def build_turn_context(all_context: str, time_str: str) -> str:
+    return f"""
 【目前已知事實與回憶】
 {all_context}
 
 【目前時間】
 {time_str}
-
-【敘事規範】
-- 絕對禁止使用英文，無論對話內容多麼戲劇化，都必須維持繁體中文。
-- 以小說風格對話，必須穿插 *星號* 描述動作。
-- 語氣要自然，不要像機器人列出事實，而是將事實融入你的關懷中。
 """
-    messages = [{"role": "system", "content": system_content}]
+
+def build_chat_messages(role_key: str, history: list, all_context: str, time_str: str, user_prompt: str) -> list:
+    """
+    依「最穩定 → 最常變動」排列訊息：
+    人格前綴 → 歷史對話 → 本輪事實 / 時間 / 回憶 → 使用者訊息
+    """
+    turn_context = build_turn_context(all_context, time_str)
+    messages = [{"role": "system", "content": build_persona_prompt(role_key)}]
     for h in history:
         messages.append(h)
+    messages.append({"role": "system", "content": turn_context})
     messages.append({"role": "user", "content": user_prompt})
+    return messages
+
+async def _build_chat_payload(user_id: int, user_prompt: str, history: list, stream: bool) -> dict:
+    # 事實查詢包含 SQLite 與向量搜尋（同步 I/O），移到執行緒避免卡住 event loop
+    fact_lines = await asyncio.to_thread(get_fact_lines, user_id)
+    memory_lines = await asyncio.to_thread(get_semantic_memory_lines, user_id, user_prompt)
+    
+    role_key = get_user_role(user_id)
+    time_str = datetime.now(get_user_zoneinfo(user_id)).strftime("%Y-%m-%d %H:%M")
+
+    # 依 token 預算裁剪事實、回憶與歷史，確保整段 prompt 放得進 num_ctx
+    fact_lines, memory_lines, history = fit_context(
+        build_persona_prompt(role_key),
+        user_prompt,
+        fact_lines,
+        memory_lines,
+        history,
+        fixed_extra=build_turn_context(format_facts([], []), time_str),
+    )
+    all_context = format_facts(fact_lines, memory_lines)
+
+    return {
+        "model": MODEL_NAME,
+        "messages": build_chat_messages(role_key, history, all_context, time_str, user_prompt),
+        "stream": stream,
+        "options": CHAT_OPTIONS,
+    }
+
+def _record_prompt_stats(payload: dict, data: dict):
+    estimated = sum(count_tokens(m["content"]) for m in payload["messages"])
+    evaluated = data.get("prompt_eval_count", 0)
+    cached = max(estimated - evaluated, 0)
+
+    _prompt_stats["calls"] += 1
+    _prompt_stats["estimated_prompt_tokens"] += estimated
+    _prompt_stats["evaluated_tokens"] += evaluated
+    _prompt_stats["estimated_cached_tokens"] += cached
+    _prompt_stats["last"] = {
+        "estimated_prompt_tokens": estimated,
+        "prompt_eval_count": evaluated,
+        "estimated_cached_tokens": cached,
+        "prompt_eval_ms": data.get("prompt_eval_duration", 0) / 1e6,
+        "eval_count": data.get("eval_count", 0),
+        "eval_ms": data.get("eval_duration", 0) / 1e6,
+    }
+
+def get_prompt_stats() -> dict:
+    """
+    回傳累計與最近一次的 prompt 計算量，用來確認 prefix cache 是否生效
+    （estimated_* 以 count_tokens 估計，只有 evaluated_tokens / prompt_eval_count 是 Ollama 回報的實際值）
+    """
+    return dict(_prompt_stats)
+
+async def generate_response(user_id: int, user_prompt: str, history: list) -> str:
+    payload = await _build_chat_payload(user_id, user_prompt, history, stream=False)
     try:
-        response = requests.post(
-            OLLAMA_URL,
-            json={
-                "model": MODEL_NAME,
-                "messages": messages,
-                "stream": False,
-                "options": {
-                    "temperature": 0.3, # 保持較低隨機性，防止胡編亂造
-                    "top_p": 0.9,
-                    "num_ctx": 4096, 
-                },
-            },
-            timeout=60,
-        )
-        response.raise_for_status()
-        return response.json()["message"]["content"]
+        data = await post_chat(payload, timeout=60)
+        _record_prompt_stats(payload, data)
+        return data["message"]["content"]
 
     except Exception as e:
         print(f"❌ 生成回覆出錯：{e}")
-        return "❤️（*有些不安地攪動手指* 我剛才好像走神了...你能再說一遍嗎？）"
-
-def parse_reminder_intent(user_text: str) -> Optional[dict]:
-    messages = [
-        {"role": "system", "content": REMINDER_INTENT_PROMPT},
-        {"role": "user", "content": user_text},
-    ]
-
+        return REPLY_FALLBACK
+
+async def stream_response(user_id: int, user_prompt: str, history: list) -> AsyncIterator[str]:
+    """
+    串流版本的 generate_response：逐段 yield 模型產生的文字
+    沒有產生任何文字（例如連線失敗）時，yield 預設的安撫訊息
+    """
+    payload = await _build_chat_payload(user_id, user_prompt, history, stream=True)
+    produced = False
     try:
-        response = requests.post(
-            OLLAMA_URL,
-            json={
-                "model": MODEL_NAME,
-                "messages": messages,
-                "stream": False,
-                "options": {"temperature": 0.0},
-            },
-            timeout=30,
-        )
-
-        raw = response.json()["message"]["content"].strip()
+        async for chunk in stream_chat(payload, timeout=60):
+            piece = chunk.get("message", {}).get("content", "")
+            if piece:
+                produced = True
+                yield piece
+            if chunk.get("done"):
+                _record_prompt_stats(payload, chunk)
+                break
 
-        import re
-        match = re.search(r"\{[\s\S]*?\}", raw)
-        if not match:
-            return None
-
-        data = json.loads(match.group())
+    except Exception as e:
+        print(f"❌ 串流回覆出錯：{e}")
 
-        delay = data.get("delay_seconds")
-        content = data.get("content")
+    if not produced:
+        yield REPLY_FALLBACK
 
-        if not delay or not isinstance(delay, (int, float)):
-            return None
+def _normalize_reminder(data) -> Optional[dict]:
+    if not isinstance(data, dict):
+        return None
 
-        return {
-            "delay_seconds": int(delay),
-            "content": content or "該注意時間囉"
-        }
+    delay = data.get("delay_seconds")
+    content = data.get("content")
 
-    except Exception as e:
-        print("⚠️ 提醒意圖解析失敗：", e)
+    if not delay or not isinstance(delay, (int, float)):
         return None
 
-def parse_delete_intent(user_text: str) -> Optional[dict]:
+    return {
+        "delay_seconds": int(delay),
+        "content": content or "該注意時間囉"
+    }
+
+async def extract_message_intents(user_text: str) -> dict:
+    """
+    單次 LLM 呼叫同時取得：刪除意圖、所有短時間提醒、是否存為長期記憶
+    回傳格式：
+    {
+        "delete": {"is_delete", "time_hint", "content_hint"} | None,
+        "reminders": [{"delay_seconds", "content"}, ...],
+        "memory": dict | None,      # 與 should_store_memory 相同
+    }
+    """
+    intents = {"delete": None, "reminders": [], "memory": None}
+
+    # 規則快速路徑：刪除 / 短提醒都能由規則確定時，
+    # 只有訊息帶有記憶線索（自我介紹、偏好…）才呼叫記憶判斷器
+    fast = pre_classify(user_text)
+    if fast is not None:
+        intents.update(fast)
+        judge = not fast["delete"] and needs_memory_judge(user_text)
+        record_fast_path(not judge)
+        if judge:
+            intents["memory"] = await should_store_memory(user_text)
+        return intents
+
+    record_fast_path(False)
+
     messages = [
-        {"role": "system", "content": DELETE_REMINDER_PROMPT},
+        {"role": "system", "content": MESSAGE_INTENT_PROMPT},
         {"role": "user", "content": user_text},
     ]
 
     try:
-        response = requests.post(
-            OLLAMA_URL,
-            json={
+        content = await chat_content(
+            {
                 "model": MODEL_NAME,
                 "messages": messages,
                 "stream": False,
-                "options": {
-                    "temperature": 0.0 
-                },
+                "format": "json",
+                "options": {"temperature": 0.0},
             },
             timeout=30,
         )
-        content = response.json()["message"]["content"].strip()
-        result = json.loads(content)
-
-        if not isinstance(result, dict):
-            return None
-        if not result.get("is_delete"):
-            return None
-
-        return result
-
+        data = json.loads(content.strip())
     except Exception as e:
-        print("⚠️ 刪除意圖解析失敗：", e)
-        return None
\ No newline at end of file
+        print("⚠️ 訊息意圖解析失敗：", e)
+        return intents
+
+    if not isinstance(data, dict):
+        return intents
+
+    delete = data.get("delete")
+    if isinstance(delete, dict) and delete.get("is_delete"):
+        intents["delete"] = delete
+
+    reminders = data.get("reminders") or []
+    if isinstance(reminders, dict):
+        reminders = [reminders]
+    if isinstance(reminders, list):
+        for r in reminders:
+            reminder = _normalize_reminder(r)
+            if reminder:
+                intents["reminders"].append(reminder)
+
+    memory = data.get("memory")
+    if isinstance(memory, dict):
+        intents["memory"] = memory
+
+    return intents
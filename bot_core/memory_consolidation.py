@@ -0,0 +1,87 @@
+import asyncio
+from collections import Counter
+
+import numpy as np
+
+from .llm_service import summarize_memories
+from .memory_manager import (
+    embedder,
+    get_memory_rows,
+    get_users_with_memories_over,
+    merge_memories,
+    trim_memories,
+)
+from .memory_ranking import IMPORTANCE_CAP
+
+# 記憶少於這個數量的使用者不需要整理
+CONSOLIDATE_MIN_MEMORIES = 30
+# 相似度達到此值的記憶歸為同一群（比寫入時的重複門檻寬鬆，交給模型合併）
+CLUSTER_SIMILARITY = 0.80
+# 每群最多合併幾條，避免摘要過長失去細節
+MAX_CLUSTER_SIZE = 8
+# 整理後每位使用者最多保留的記憶數量（需大於 memory_shards.DEDICATED_THRESHOLD）
+MAX_MEMORIES_PER_USER = 200
+
+
+def _clusters(vectors: np.ndarray) -> list:
+    """
+    貪婪分群：依序以尚未分群的記憶為中心，收集與它相似的記憶
+    回傳只含兩條以上記憶的群（索引列表）
+    """
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = vectors / np.where(norms == 0, 1, norms)
+    similarity = unit @ unit.T
+
+    assigned = np.zeros(len(vectors), dtype=bool)
+    clusters = []
+    for i in range(len(vectors)):
+        if assigned[i]:
+            continue
+        members = [
+            j for j in np.flatnonzero(similarity[i] >= CLUSTER_SIMILARITY)
+            if not assigned[j]
+        ][:MAX_CLUSTER_SIZE]
+        assigned[members] = True
+        if len(members) > 1:
+            clusters.append(members)
+    return clusters
+
+
+async def consolidate_user(user_id: int) -> dict:
+    rows = await asyncio.to_thread(get_memory_rows, user_id)
+    if len(rows) <= CONSOLIDATE_MIN_MEMORIES:
+        return {"merged": 0, "trimmed": 0}
+
+    # 寫入時已算過，幾乎都會命中 embedding 快取
+    vectors = await asyncio.to_thread(embedder.embed, [r[2] for r in rows])
+
+    merged = 0
+    for members in _clusters(vectors):
+        group = [rows[i] for i in members]
+        content = await summarize_memories([r[2] for r in group])
+        if not content:
+            continue
+
+        category = Counter(r[1] for r in group).most_common(1)[0][0]
+        importance = min(max(r[3] for r in group) + 1, IMPORTANCE_CAP)
+        await asyncio.to_thread(
+            merge_memories, user_id, [r[0] for r in group], category, content, importance
+        )
+        merged += len(group)
+
+    trimmed = await asyncio.to_thread(trim_memories, user_id, MAX_MEMORIES_PER_USER)
+    return {"merged": merged, "trimmed": trimmed}
+
+
+async def consolidate_all():
+    """
+    整理所有記憶數量超過門檻的使用者（每日背景執行一次）
+    """
+    user_ids = await asyncio.to_thread(get_users_with_memories_over, CONSOLIDATE_MIN_MEMORIES)
+    for user_id in user_ids:
+        try:
+            result = await consolidate_user(user_id)
+            if result["merged"] or result["trimmed"]:
+                print(f"🧹 記憶整理 {user_id}: 合併 {result['merged']} 條、刪除 {result['trimmed']} 條")
+        except Exception as e:
+            print(f"記憶整理失敗 {user_id}:", e)
@@ -0,0 +1,115 @@
+import asyncio
+from typing import Callable
+
+# 累積到這麼多筆就立即寫入
+DEFAULT_BATCH_SIZE = 16
+# 第一筆進佇列後最多等這麼久就寫入，不管湊滿了沒
+DEFAULT_MAX_DELAY = 2.0
+# 寫入失敗（例如 Ollama 暫時連不上）後多久重試
+RETRY_SECONDS = 30
+
+
+class MemoryIngestor:
+    """
+    記憶的背景寫入佇列：save_memory 只寫 SQLite，memory_id 交給這裡，
+    湊滿 batch_size 筆或等待 max_delay 秒後，一次呼叫 index(ids)
+    （一次 embedding 請求 + 一次 collection.upsert）
+
+    尚未寫入的資料在 SQLite 中標記為 indexed = 0，啟動時由 load() 重播，
+    因此中途當機不會遺失記憶
+    """
+
+    def __init__(
+        self,
+        index: Callable[[list], int],
+        load: Callable[[], list] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_delay: float = DEFAULT_MAX_DELAY,
+        name: str = "memory_ingestor",
+    ):
+        self._index = index
+        self._load = load
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._name = name
+        self._loop = None
+        self._queue = None
+        self._task = None
+        self.indexed = 0
+        self.batches = 0
+        self.failed = 0
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run(), name=self._name)
+
+    def stop(self):
+        # 佇列中尚未寫入的資料仍是 indexed = 0，下次啟動會重播
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def submit(self, memory_id: int):
+        """
+        加入一筆待寫入的記憶；可從任何執行緒呼叫
+        """
+        if self._loop is None:
+            # 尚未啟動：啟動時會由 load() 重新載入
+            return
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, memory_id)
+
+    async def _replay(self):
+        if self._load is None:
+            return
+        try:
+            pending = await asyncio.to_thread(self._load)
+        except Exception as e:
+            print(f"{self._name} 載入未寫入的記憶失敗:", e)
+            return
+        for memory_id in pending:
+            self._queue.put_nowait(memory_id)
+
+    async def _next_batch(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = self._loop.time() + self._max_delay
+
+        while len(batch) < self._batch_size:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        await self._replay()
+
+        while True:
+            batch = list(dict.fromkeys(await self._next_batch()))
+            try:
+                self.indexed += await asyncio.to_thread(self._index, batch)
+                self.batches += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"{self._name} 寫入向量庫失敗（{len(batch)} 筆）:", e)
+                self._loop.call_later(RETRY_SECONDS, self._requeue, batch)
+
+    def _requeue(self, batch: list):
+        for memory_id in batch:
+            self._queue.put_nowait(memory_id)
+
+    def stats(self) -> dict:
+        return {
+            "depth": self._queue.qsize() if self._queue else 0,
+            "indexed": self.indexed,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
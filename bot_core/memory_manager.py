@@ -1,156 +1,565 @@
-import sqlite3
 import os
+import threading
 from datetime import datetime, timedelta, date
-import chromadb
-from chromadb.utils import embedding_functions
-
-DB_PATH = "data/memories.db"
-CHROMA_PATH = "data/vector_db"
-
-ollama_ef = embedding_functions.OllamaEmbeddingFunction(
-    url="http://localhost:11434/api/embeddings",
-    model_name="bge-m3"
-)
-chroma_client = chromadb.PersistentClient(path=CHROMA_PATH)
-collection = chroma_client.get_or_create_collection(
-    name="user_memories", 
-    embedding_function=ollama_ef
-)
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import numpy as np
+
+from .database import get_conn
+from .cache import LRUCache
+from .embedding_cache import CachedEmbeddingFunction
+from .ollama_client import EMBED_MODEL, embed_texts
+from .text_search import search_terms, fts_query, coverage, is_single_cjk, rrf_fuse
+from .memory_ranking import IMPORTANCE_CAP, MAX_MEMORIES, rank_memories
+from .vector_store import create_vector_store
+
+# 向量後端：chroma（預設）或 numpy（向量存在 SQLite，不需載入 chromadb）
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+
+# 所有 embedding 都經過快取；寫入與查詢時直接把向量交給向量後端
+embedder = CachedEmbeddingFunction(embed_texts, model_name=EMBED_MODEL)
+vector_store = create_vector_store(VECTOR_BACKEND)
+
+def _fts_owner(user_id: int) -> str:
+    # 使用者也寫成 FTS5 的一個詞，MATCH 時與檢索詞 AND，只會走到該使用者的索引資料
+    return f"u{user_id}"
+
+def _index_terms(conn, memory_id: int, user_id: int, content: str):
+    conn.execute(
+        "INSERT INTO memories_fts (rowid, terms, owner) VALUES (?, ?, ?)",
+        (memory_id, " ".join(search_terms(content)), _fts_owner(user_id))
+    )
+
+def _create_memories_fts(conn):
+    # 分詞在 Python 完成（CJK bigram），FTS5 只需依空白切開
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS memories_fts USING fts5(terms, owner)")
+    conn.execute("""
+    CREATE TRIGGER IF NOT EXISTS memories_fts_delete AFTER DELETE ON memories
+    BEGIN
+        DELETE FROM memories_fts WHERE rowid = old.id;
+    END
+    """)
+    for memory_id, user_id, content in conn.execute(
+        "SELECT id, user_id, content FROM memories"
+    ).fetchall():
+        _index_terms(conn, memory_id, user_id, content)
+
+# ======================
+# 資料庫版本遷移
+# ======================
+# 依序執行，每個版本只會執行一次；目前版本記錄在 PRAGMA user_version。
+# 舊的 data/memories.db（user_version = 0）會直接原地升級。
+# 新增結構變更時請在最後面追加，不要修改已發佈的版本。
+MIGRATIONS = [
+    # 1：初始資料表
+    """
+    CREATE TABLE IF NOT EXISTS memories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        category TEXT NOT NULL,
+        content TEXT NOT NULL,
+        importance INTEGER DEFAULT 1,
+        created_at TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS user_settings (
+        user_id INTEGER PRIMARY KEY,
+        current_role TEXT DEFAULT 'lover',
+        bot_name TEXT DEFAULT '你的伴侶',
+        user_gender TEXT DEFAULT '未設定',
+        timezone TEXT DEFAULT 'Asia/Taipei'
+    );
+
+    CREATE TABLE IF NOT EXISTS reminders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        remind_at TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS anniversaries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        type TEXT NOT NULL,          -- birthday / anniversary
+        month INTEGER NOT NULL,
+        day INTEGER NOT NULL,
+        label TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    """,
+
+    # 2：查詢用索引
+    """
+    -- 到期提醒掃描
+    CREATE INDEX IF NOT EXISTS idx_reminders_remind_at
+        ON reminders (remind_at);
+    -- 個人行程查詢（today / week / 已知事實）；含 content 即可只讀索引
+    CREATE INDEX IF NOT EXISTS idx_reminders_user_remind_at
+        ON reminders (user_id, remind_at, content);
+    -- 依日期找紀念日
+    CREATE INDEX IF NOT EXISTS idx_anniversaries_month_day
+        ON anniversaries (month, day);
+    CREATE INDEX IF NOT EXISTS idx_anniversaries_user
+        ON anniversaries (user_id);
+    -- get_memories 的排序
+    CREATE INDEX IF NOT EXISTS idx_memories_user_importance
+        ON memories (user_id, importance, created_at);
+    """,
+
+    # 3：短時間提醒（「10分鐘後提醒我…」），重啟後可重新排程
+    """
+    CREATE TABLE IF NOT EXISTS short_reminders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        fire_at TEXT NOT NULL,
+        content TEXT NOT NULL,
+        created_at TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_short_reminders_user
+        ON short_reminders (user_id, fire_at);
+    """,
+
+    # 4：提醒改為 claim / ack 投遞；lease_until 之前其他人不會再取走同一筆
+    """
+    ALTER TABLE reminders ADD COLUMN lease_until TEXT;
+    ALTER TABLE reminders ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;
+    """,
+
+    # 5：每日通知的發送紀錄（避免重啟後重複發送）與依時區分組查詢
+    """
+    CREATE TABLE IF NOT EXISTS dispatch_ledger (
+        kind TEXT NOT NULL,          -- morning_summary / anniversary
+        ref_id INTEGER NOT NULL,     -- user_id 或 anniversary id
+        local_date TEXT NOT NULL,    -- 使用者當地日期 YYYY-MM-DD
+        sent_at TEXT NOT NULL,
+        PRIMARY KEY (kind, ref_id, local_date)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_user_settings_timezone
+        ON user_settings (timezone);
+    """,
+
+    # 6：embedding 快取（模型名稱 + 正規化文字的 sha256 → float32 向量）
+    """
+    CREATE TABLE IF NOT EXISTS embedding_cache (
+        key BLOB PRIMARY KEY,
+        model TEXT NOT NULL,
+        dim INTEGER NOT NULL,
+        vector BLOB NOT NULL,
+        created_at TEXT NOT NULL
+    ) WITHOUT ROWID;
+    """,
+
+    # 7：記憶改為背景批次寫入向量庫；indexed = 0 代表尚未寫入 Chroma
+    # 既有的記憶在舊版本已同步寫入，直接標記為已索引
+    """
+    ALTER TABLE memories ADD COLUMN indexed INTEGER NOT NULL DEFAULT 0;
+    UPDATE memories SET indexed = 1;
+    CREATE INDEX IF NOT EXISTS idx_memories_unindexed
+        ON memories (id) WHERE indexed = 0;
+    """,
+
+    # 8：記憶的關鍵字索引（FTS5）；刪除由 trigger 同步，新增時由程式寫入分詞結果
+    _create_memories_fts,
+
+    # 9：使用專屬 Chroma collection 的使用者（其餘使用者依 user_id 雜湊分片）
+    """
+    CREATE TABLE IF NOT EXISTS memory_shards (
+        user_id INTEGER PRIMARY KEY,
+        collection TEXT NOT NULL
+    );
+    """,
+
+    # 10：NumPy 向量後端使用的 float32 embedding
+    """
+    ALTER TABLE memories ADD COLUMN embedding BLOB;
+    """,
+
+    # 11：對話歷史（每位使用者固定 N 格的環狀緩衝區，slot = seq % N）
+    """
+    CREATE TABLE IF NOT EXISTS conversation_history (
+        user_id INTEGER NOT NULL,
+        slot INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        PRIMARY KEY (user_id, slot)
+    ) WITHOUT ROWID;
+    """,
+]
+
+def _migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for target, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        # 整個版本在同一個交易內完成，失敗時不會留下一半的結構
+        if callable(step):
+            conn.execute("BEGIN")
+            try:
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        else:
+            conn.executescript(
+                f"BEGIN;\n{step}\nPRAGMA user_version = {target};\nCOMMIT;"
+            )
+        print(f"資料庫已升級至版本 {target}")
+
+    if version < len(MIGRATIONS):
+        # 更新查詢規劃器的統計資料，讓新索引立即被使用
+        conn.execute("PRAGMA optimize")
 
 def init_db():
     os.makedirs("data", exist_ok=True)
-    with sqlite3.connect(DB_PATH) as conn:
+    _migrate(get_conn())
 
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS memories (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            category TEXT NOT NULL,
-            content TEXT NOT NULL,
-            importance INTEGER DEFAULT 1,
-            created_at TEXT NOT NULL
-        )
-        """)
+    vector_store.check()
 
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS user_settings (
-            user_id INTEGER PRIMARY KEY,
-            current_role TEXT DEFAULT 'lover',
-            bot_name TEXT DEFAULT '你的伴侶',
-            user_gender TEXT DEFAULT '未設定',
-            timezone TEXT DEFAULT 'Asia/Taipei'
-        )
-        """)
+# ======================
+# 使用者設定快取
+# ======================
+# 角色 / 性別 / 時區在每則訊息會被讀很多次，但幾乎不會改變。
+# 讀取時整列載入快取，set_user_* 寫入後立即讓快取失效。
+SETTINGS_CACHE_SIZE = 4096
+DEFAULT_TIMEZONE = "Asia/Taipei"
 
+_settings_cache = LRUCache(SETTINGS_CACHE_SIZE)
 
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS reminders (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            remind_at TEXT NOT NULL,
-            content TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        )
-        """)
+# 「已知事實」快照：{user_id: {"lines": [...], "expires_at": datetime | None}}
+# 寫入行程 / 紀念日 / 設定時失效；列出的最早行程時間一過也自動失效
+FACT_CACHE_SIZE = 4096
+_fact_cache = LRUCache(FACT_CACHE_SIZE)
 
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS anniversaries (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            type TEXT NOT NULL,          -- birthday / anniversary
-            month INTEGER NOT NULL,
-            day INTEGER NOT NULL,
-            label TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        )
-        """)
+# 讀取可能在 worker thread（asyncio.to_thread）執行，寫入在事件迴圈上：
+# 讀取前先記下使用者的版本，寫入時遞增版本；讀完若版本已變，代表讀到的可能是舊資料，不放進快取
+_cache_versions = {}
+_cache_lock = threading.Lock()
 
-def get_user_role(user_id: int) -> str:
-    with sqlite3.connect(DB_PATH) as conn:
+def _cache_version(user_id: int) -> int:
+    return _cache_versions.get(user_id, 0)
+
+def _cache_set(cache: LRUCache, user_id: int, version: int, value):
+    with _cache_lock:
+        if _cache_versions.get(user_id, 0) == version:
+            cache.set(user_id, value)
+
+def invalidate_facts(user_id: int):
+    with _cache_lock:
+        _cache_versions[user_id] = _cache_versions.get(user_id, 0) + 1
+        _fact_cache.pop(user_id)
+
+def _invalidate_user(user_id: int):
+    with _cache_lock:
+        _cache_versions[user_id] = _cache_versions.get(user_id, 0) + 1
+        _settings_cache.pop(user_id)
+        _fact_cache.pop(user_id)
+
+def _to_zoneinfo(tz: str) -> ZoneInfo:
+    try:
+        return ZoneInfo(tz)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+def _get_settings(user_id: int) -> dict:
+    settings = _settings_cache.get(user_id)
+    if settings is not None:
+        return settings
+
+    version = _cache_version(user_id)
+    with get_conn() as conn:
         row = conn.execute(
-            "SELECT current_role FROM user_settings WHERE user_id = ?",
+            "SELECT current_role, user_gender, timezone FROM user_settings WHERE user_id = ?",
             (user_id,)
         ).fetchone()
-        return row[0] if row else "lover"
+
+    timezone = row[2] if row and row[2] else DEFAULT_TIMEZONE
+    settings = {
+        "exists": row is not None,
+        "role": row[0] if row else "lover",
+        "gender": row[1] if row else "未設定",
+        "timezone": timezone,
+        "zone": _to_zoneinfo(timezone),
+    }
+    _cache_set(_settings_cache, user_id, version, settings)
+    return settings
+
+def get_settings_cache_stats() -> dict:
+    return _settings_cache.stats()
+
+def get_embedding_cache_stats() -> dict:
+    return embedder.stats()
+
+def get_user_role(user_id: int) -> str:
+    return _get_settings(user_id)["role"]
 
 
 def set_user_role(user_id: int, role_name: str):
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         conn.execute("""
         INSERT INTO user_settings (user_id, current_role)
         VALUES (?, ?)
         ON CONFLICT(user_id) DO UPDATE SET current_role = excluded.current_role
         """, (user_id, role_name))
+    _invalidate_user(user_id)
 
 def get_user_gender(user_id: int) -> str:
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT user_gender FROM user_settings WHERE user_id = ?",
-            (user_id,)
-        ).fetchone()
-        return row[0] if row else "未設定"
+    return _get_settings(user_id)["gender"]
 
 
 def set_user_gender(user_id: int, gender: str):
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         conn.execute("""
         INSERT INTO user_settings (user_id, user_gender)
         VALUES (?, ?)
         ON CONFLICT(user_id) DO UPDATE SET user_gender = excluded.user_gender
         """, (user_id, gender))
+    _invalidate_user(user_id)
 
 def get_user_timezone(user_id: int) -> str:
-    with sqlite3.connect(DB_PATH) as conn:
-        row = conn.execute(
-            "SELECT timezone FROM user_settings WHERE user_id = ?",
-            (user_id,)
-        ).fetchone()
-    return row[0] if row and row[0] else "Asia/Taipei"
+    return _get_settings(user_id)["timezone"]
+
+
+def get_user_zoneinfo(user_id: int) -> ZoneInfo:
+    """
+    回傳使用者時區的 ZoneInfo（已快取；設定無效時退回 Asia/Taipei）
+    """
+    return _get_settings(user_id)["zone"]
 
 
 def set_user_timezone(user_id: int, timezone: str):
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         conn.execute("""
         INSERT INTO user_settings (user_id, timezone)
         VALUES (?, ?)
         ON CONFLICT(user_id) DO UPDATE SET timezone = excluded.timezone
         """, (user_id, timezone))
+    _invalidate_user(user_id)
+
+# 新增記憶時通知背景寫入佇列：callback(memory_id)
+_memory_listeners = []
+
+def add_memory_listener(callback):
+    _memory_listeners.append(callback)
+
+def save_memory(user_id: int, category: str, content: str, importance=1) -> int:
+    """
+    只寫入 SQLite（indexed = 0）就回傳；embedding 與寫入向量後端由背景的
+    MemoryIngestor 批次處理，SQLite 的資料列是唯一的事實來源
+    importance：記憶判斷器給的 1~5 分，無法解析時視為 1
+    """
+    try:
+        importance = min(max(int(importance), 1), IMPORTANCE_CAP)
+    except (TypeError, ValueError):
+        importance = 1
 
-def save_memory(user_id: int, category: str, content: str):
-    timestamp = datetime.utcnow().isoformat()
-    
-    # 1. 存入 SQLite (供系統查詢)
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         cursor = conn.execute("""
-        INSERT INTO memories (user_id, category, content, created_at)
-        VALUES (?, ?, ?, ?)
-        """, (user_id, category, content, timestamp))
-        memory_id = str(cursor.lastrowid)
-
-    # 2. 存入 ChromaDB (供語義搜尋)
-    collection.add(
-        documents=[content],
-        ids=[f"mem_{memory_id}"],
-        metadatas=[{"user_id": user_id, "category": category}]
-    )
+        INSERT INTO memories (user_id, category, content, importance, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        """, (user_id, category, content, importance, datetime.utcnow().isoformat()))
+        memory_id = cursor.lastrowid
+        _index_terms(conn, memory_id, user_id, content)
+
+    for callback in _memory_listeners:
+        callback(memory_id)
+    return memory_id
+
+def get_unindexed_memory_ids() -> list:
+    """
+    尚未寫入向量庫的記憶（啟動時重播，補上當機前沒寫完的部分）
+    """
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT id FROM memories WHERE indexed = 0 ORDER BY id"
+        ).fetchall()
+    return [r[0] for r in rows]
+
+# 與同一使用者既有記憶的 cosine 相似度達到此值，視為同一件事（例如「喜歡貓」的各種換句話說）
+DUPLICATE_SIMILARITY = 0.92
+# 每筆新記憶向向量後端取回幾個最近鄰來比對
+DUPLICATE_CANDIDATES = 3
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def _find_duplicate(user_id: int, vector: np.ndarray):
+    """
+    回傳與 vector 幾乎相同的既有記憶 id；沒有則回傳 None
+    """
+    try:
+        matches = vector_store.query(user_id, vector, DUPLICATE_CANDIDATES)
+    except Exception as e:
+        print(f"⚠️ 重複記憶比對失敗: {e}")
+        return None
+
+    for memory_id, _, similarity in matches:
+        if similarity >= DUPLICATE_SIMILARITY:
+            return memory_id
+    return None
+
+def index_memories(memory_ids: list) -> int:
+    """
+    一次批次 embedding 並寫入向量後端，成功後標記 indexed = 1
+    使用 upsert：同一筆被重播時不會重複
+
+    與既有記憶（或同一批中較早的記憶）幾乎相同的新記憶不另外保存，
+    改為刪除該列並提高原本那條記憶的 importance
+    """
+    if not memory_ids:
+        return 0
+
+    placeholders = ",".join("?" * len(memory_ids))
+    with get_conn() as conn:
+        rows = conn.execute(f"""
+        SELECT id, user_id, category, content
+        FROM memories
+        WHERE indexed = 0 AND id IN ({placeholders})
+        ORDER BY id
+        """, memory_ids).fetchall()
+
+    if not rows:
+        return 0
+
+    vectors = _unit(embedder.embed([r[3] for r in rows]))
+    kept = []
+    duplicates = []  # (新記憶 id, 保留的記憶 id)
+
+    for i, row in enumerate(rows):
+        same_batch = [j for j in kept if rows[j][1] == row[1]]
+        if same_batch:
+            similarity = vectors[same_batch] @ vectors[i]
+            best = int(np.argmax(similarity))
+            if similarity[best] >= DUPLICATE_SIMILARITY:
+                duplicates.append((row[0], rows[same_batch[best]][0]))
+                continue
+
+        existing = _find_duplicate(row[1], vectors[i])
+        if existing is not None:
+            duplicates.append((row[0], existing))
+        else:
+            kept.append(i)
+
+    by_user = {}
+    for i in kept:
+        by_user.setdefault(rows[i][1], []).append(i)
+
+    for user_id, members in by_user.items():
+        vector_store.upsert(
+            user_id,
+            [rows[i][0] for i in members],
+            [rows[i][3] for i in members],
+            vectors[members],
+            [rows[i][2] for i in members]
+        )
+
+    with get_conn() as conn:
+        conn.executemany(
+            "UPDATE memories SET indexed = 1 WHERE id = ?",
+            [(rows[i][0],) for i in kept]
+        )
+        conn.executemany(
+            "DELETE FROM memories WHERE id = ?",
+            [(new_id,) for new_id, _ in duplicates]
+        )
+        conn.executemany(
+            "UPDATE memories SET importance = MIN(importance + 1, ?) WHERE id = ?",
+            [(IMPORTANCE_CAP, existing_id) for _, existing_id in duplicates]
+        )
+
+    for user_id in by_user:
+        vector_store.after_write(user_id, _count_indexed_memories(user_id))
+    return len(rows)
+
+def _count_indexed_memories(user_id: int) -> int:
+    with get_conn() as conn:
+        return conn.execute(
+            "SELECT COUNT(*) FROM memories WHERE user_id = ? AND indexed = 1",
+            (user_id,)
+        ).fetchone()[0]
+
+# ======================
+# 記憶整理（由背景的 memory_consolidation 使用）
+# ======================
+def get_users_with_memories_over(count: int) -> list:
+    with get_conn() as conn:
+        rows = conn.execute("""
+        SELECT user_id FROM memories
+        WHERE indexed = 1
+        GROUP BY user_id
+        HAVING COUNT(*) > ?
+        """, (count,)).fetchall()
+    return [r[0] for r in rows]
+
+def get_memory_rows(user_id: int) -> list:
+    """
+    回傳 [(id, category, content, importance, created_at), ...]（只含已寫入向量庫的記憶）
+    """
+    with get_conn() as conn:
+        return conn.execute("""
+        SELECT id, category, content, importance, created_at
+        FROM memories
+        WHERE user_id = ? AND indexed = 1
+        ORDER BY id
+        """, (user_id,)).fetchall()
+
+def merge_memories(user_id: int, memory_ids: list, category: str, content: str, importance: int) -> int:
+    """
+    以一條摘要取代多條記憶：新記憶以 indexed = 0 寫入，交給背景寫入佇列；
+    舊記憶從 SQLite 與向量後端刪除
+    """
+    placeholders = ",".join("?" * len(memory_ids))
+    with get_conn() as conn:
+        cursor = conn.execute("""
+        INSERT INTO memories (user_id, category, content, importance, created_at)
+        VALUES (?, ?, ?, ?, ?)
+        """, (user_id, category, content, importance, datetime.utcnow().isoformat()))
+        merged_id = cursor.lastrowid
+        _index_terms(conn, merged_id, user_id, content)
+        conn.execute(
+            f"DELETE FROM memories WHERE user_id = ? AND id IN ({placeholders})",
+            (user_id, *memory_ids)
+        )
+
+    vector_store.delete(user_id, memory_ids)
+
+    for callback in _memory_listeners:
+        callback(merged_id)
+    return merged_id
+
+def trim_memories(user_id: int, keep: int) -> int:
+    """
+    只保留 importance 最高（同分時較新）的 keep 條記憶，回傳刪除數量
+    """
+    with get_conn() as conn:
+        rows = conn.execute("""
+        DELETE FROM memories
+        WHERE user_id = ? AND indexed = 1 AND id NOT IN (
+            SELECT id FROM memories
+            WHERE user_id = ? AND indexed = 1
+            ORDER BY importance DESC, created_at DESC
+            LIMIT ?
+        )
+        RETURNING id
+        """, (user_id, user_id, keep)).fetchall()
+
+    if rows:
+        vector_store.delete(user_id, [r[0] for r in rows])
+    return len(rows)
 
 def search_semantic_memories(user_id: int, query_text: str, limit: int = 3):
     """搜尋與當前話題最相關的 3 條記憶"""
     try:
-        results = collection.query(
-            query_texts=[query_text],
-            n_results=limit,
-            where={"user_id": user_id}
-        )
-        if not results['documents'] or not results['documents'][0]:
-            return ""
-        return "\n".join([f"- {doc}" for doc in results['documents'][0]])
+        matches = vector_store.query(user_id, embedder.embed([query_text], persist=False)[0], limit)
+        return "\n".join(f"- {doc}" for _, doc, _ in matches)
     except Exception as e:
         print(f"⚠️ 語義搜尋失敗: {e}")
         return ""
 
 def get_memories(user_id: int, limit: int = 5) -> str:
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         rows = conn.execute("""
         SELECT category, content
         FROM memories
@@ -164,15 +573,27 @@ def get_memories(user_id: int, limit: int = 5) -> str:
 
     return "\n".join(f"- ({c}) {t}" for c, t in rows)
 
+# 新增提醒時通知排程器：callback(reminder_id, timestamp)
+_reminder_listeners = []
+
+def add_reminder_listener(callback):
+    _reminder_listeners.append(callback)
+
 def save_reminder(user_id: int, remind_at: str, content: str):
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.execute("""
+    with get_conn() as conn:
+        cursor = conn.execute("""
         INSERT INTO reminders (user_id, remind_at, content, created_at)
         VALUES (?, ?, ?, ?)
         """, (user_id, remind_at, content, datetime.utcnow().isoformat()))
+        reminder_id = cursor.lastrowid
+    invalidate_facts(user_id)
+
+    for callback in _reminder_listeners:
+        callback(reminder_id, _parse_utc(remind_at).timestamp())
+    return reminder_id
 
 def get_reminders(user_id: int):
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         return conn.execute("""
         SELECT remind_at, content
         FROM reminders
@@ -180,22 +601,137 @@ def get_reminders(user_id: int):
         ORDER BY remind_at
         """, (user_id,)).fetchall()
 
-def pop_due_reminders(now_iso: str):
-    with sqlite3.connect(DB_PATH) as conn:
-        rows = conn.execute("""
-        SELECT id, user_id, remind_at, content
-        FROM reminders
+# 提醒被取走後，在這段時間內沒有 ack / release 就會被視為投遞失敗並可重新取走
+REMINDER_LEASE_SECONDS = 300
+
+def claim_due_reminders(lease_seconds: int = REMINDER_LEASE_SECONDS):
+    """
+    以單一 UPDATE ... RETURNING 取走所有到期且未被租用的提醒
+    回傳 [(id, user_id, remind_at, content, attempts), ...]
+    送達後必須呼叫 ack_reminders，失敗則呼叫 release_reminder
+    """
+    now = datetime.now(ZoneInfo("UTC"))
+    now_iso = now.isoformat()
+    lease_until = (now + timedelta(seconds=lease_seconds)).isoformat()
+    with get_conn() as conn:
+        return conn.execute("""
+        UPDATE reminders
+        SET lease_until = ?, attempts = attempts + 1
         WHERE remind_at <= ?
-        """, (now_iso,)).fetchall()
-        for r in rows:
-            conn.execute("DELETE FROM reminders WHERE id = ?", (r[0],))
-        return rows
+          AND (lease_until IS NULL OR lease_until <= ?)
+        RETURNING id, user_id, remind_at, content, attempts
+        """, (lease_until, now_iso, now_iso)).fetchall()
+
+def ack_reminders(reminder_ids: list):
+    """
+    確認提醒已送達（或放棄重試），從資料表刪除
+    """
+    if not reminder_ids:
+        return
+    placeholders = ",".join("?" * len(reminder_ids))
+    with get_conn() as conn:
+        user_ids = conn.execute(f"""
+        DELETE FROM reminders WHERE id IN ({placeholders})
+        RETURNING user_id
+        """, reminder_ids).fetchall()
+    for (user_id,) in set(user_ids):
+        invalidate_facts(user_id)
+
+def release_reminder(reminder_id: int, retry_at: datetime):
+    """
+    投遞失敗：保留提醒，到 retry_at 之後才可再次被取走
+    """
+    with get_conn() as conn:
+        conn.execute("""
+        UPDATE reminders SET lease_until = ? WHERE id = ?
+        """, (retry_at.isoformat(), reminder_id))
+
+def get_pending_reminder_times():
+    """
+    回傳所有尚未送出的提醒 [(timestamp, reminder_id), ...]，供排程器建立 heap
+    """
+    with get_conn() as conn:
+        rows = conn.execute("""
+        SELECT id, remind_at, lease_until FROM reminders
+        """).fetchall()
+
+    entries = []
+    for reminder_id, remind_at, lease_until in rows:
+        try:
+            when = _parse_utc(remind_at).timestamp()
+            if lease_until:
+                # 被租用中的提醒要等租約到期才會再被取走
+                when = max(when, _parse_utc(lease_until).timestamp())
+        except ValueError:
+            continue
+        entries.append((when, reminder_id))
+    return entries
+
+def save_short_reminder(user_id: int, delay_seconds: int, content: str):
+    """
+    儲存短時間提醒，回傳 (reminder_id, 觸發時間 timestamp)
+    """
+    now = datetime.now(ZoneInfo("UTC"))
+    fire_at = now + timedelta(seconds=delay_seconds)
+    with get_conn() as conn:
+        cursor = conn.execute("""
+        INSERT INTO short_reminders (user_id, fire_at, content, created_at)
+        VALUES (?, ?, ?, ?)
+        """, (user_id, fire_at.isoformat(), content, now.isoformat()))
+    return cursor.lastrowid, fire_at.timestamp()
+
+def get_pending_short_reminder_times():
+    """
+    回傳所有尚未觸發的短提醒 [(timestamp, reminder_id), ...]，重啟後重新排程用
+    """
+    with get_conn() as conn:
+        rows = conn.execute("""
+        SELECT id, fire_at FROM short_reminders
+        """).fetchall()
+    return [(_parse_utc(fire_at).timestamp(), reminder_id) for reminder_id, fire_at in rows]
+
+def pop_short_reminders(reminder_ids: list):
+    """
+    取出並刪除指定的短提醒；已被取消的 id 會被略過
+    回傳 [(id, user_id, content), ...]
+    """
+    if not reminder_ids:
+        return []
+    placeholders = ",".join("?" * len(reminder_ids))
+    with get_conn() as conn:
+        rows = conn.execute(f"""
+        SELECT id, user_id, content
+        FROM short_reminders
+        WHERE id IN ({placeholders})
+        """, reminder_ids).fetchall()
+        conn.execute(f"""
+        DELETE FROM short_reminders WHERE id IN ({placeholders})
+        """, reminder_ids)
+    return rows
+
+def cancel_short_reminder(user_id: int, content_hint: str):
+    """
+    取消第一筆內容包含 content_hint 的短提醒，回傳被取消的內容（找不到時回傳 None）
+    """
+    with get_conn() as conn:
+        rows = conn.execute("""
+        SELECT id, content
+        FROM short_reminders
+        WHERE user_id = ?
+        ORDER BY fire_at
+        """, (user_id,)).fetchall()
+
+        for reminder_id, content in rows:
+            if content_hint in content:
+                conn.execute("DELETE FROM short_reminders WHERE id = ?", (reminder_id,))
+                return content
+    return None
 
 def get_today_reminders(user_id: int):
     today = date.today().isoformat()
     tomorrow = (date.today() + timedelta(days=1)).isoformat()
 
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         return conn.execute("""
         SELECT remind_at, content
         FROM reminders
@@ -209,7 +745,7 @@ def get_week_reminders(user_id: int):
     start = date.today().isoformat()
     end = (date.today() + timedelta(days=7)).isoformat()
 
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         return conn.execute("""
         SELECT remind_at, content
         FROM reminders
@@ -220,14 +756,15 @@ def get_week_reminders(user_id: int):
         """, (user_id, start, end)).fetchall()
 
 def save_anniversary(user_id, type_, month, day, label):
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         conn.execute("""
         INSERT INTO anniversaries (user_id, type, month, day, label, created_at)
         VALUES (?, ?, ?, ?, ?, ?)
         """, (user_id, type_, month, day, label, datetime.utcnow().isoformat()))
+    invalidate_facts(user_id)
 
 def get_anniversaries(user_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         return conn.execute("""
         SELECT type, month, day, label
         FROM anniversaries
@@ -235,7 +772,7 @@ def get_anniversaries(user_id):
         """, (user_id,)).fetchall()
 
 def get_all_anniversaries():
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         return conn.execute("""
         SELECT user_id, type, month, day, label
         FROM anniversaries
@@ -244,7 +781,7 @@ def get_all_anniversaries_with_tz():
     """
     使用 JOIN 同時抓取紀念日與使用者的時區設定
     """
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         query = """
         SELECT a.user_id, a.type, a.month, a.day, a.label, 
                COALESCE(s.timezone, 'Asia/Taipei') as tz
@@ -252,68 +789,276 @@ def get_all_anniversaries_with_tz():
         LEFT JOIN user_settings s ON a.user_id = s.user_id
         """
         return conn.execute(query).fetchall()
+def get_anniversaries_on(timezone: str, month: int, day: int):
+    """
+    指定時區中，紀念日落在 month/day 的資料（走 (month, day) 索引）
+    沒有設定時區的使用者視為 Asia/Taipei
+    回傳 [(anniversary_id, user_id, type, label), ...]
+    """
+    with get_conn() as conn:
+        return conn.execute("""
+        SELECT a.id, a.user_id, a.type, a.label
+        FROM anniversaries a
+        LEFT JOIN user_settings s ON a.user_id = s.user_id
+        WHERE a.month = ? AND a.day = ?
+          AND COALESCE(s.timezone, ?) = ?
+        """, (month, day, DEFAULT_TIMEZONE, timezone)).fetchall()
+
 def get_all_users():
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         return conn.execute("""
         SELECT user_id, timezone FROM user_settings
         """).fetchall()
-def get_all_facts(user_id: int, query_text: str = None):
+
+def get_user_timezones():
+    """
+    回傳所有使用者設定過的時區（不重複）
+    """
+    with get_conn() as conn:
+        rows = conn.execute("""
+        SELECT DISTINCT timezone FROM user_settings WHERE timezone IS NOT NULL
+        """).fetchall()
+    return [r[0] for r in rows]
+
+def get_users_with_reminders_between(timezone: str, start_iso: str, end_iso: str):
+    """
+    指定時區中，在 [start_iso, end_iso) 之間有行程的使用者
+    """
+    with get_conn() as conn:
+        rows = conn.execute("""
+        SELECT DISTINCT s.user_id
+        FROM user_settings s
+        JOIN reminders r ON r.user_id = s.user_id
+        WHERE s.timezone = ?
+          AND r.remind_at >= ?
+          AND r.remind_at < ?
+        """, (timezone, start_iso, end_iso)).fetchall()
+    return [r[0] for r in rows]
+
+def get_reminders_between(user_id: int, start_iso: str, end_iso: str):
+    with get_conn() as conn:
+        return conn.execute("""
+        SELECT remind_at, content
+        FROM reminders
+        WHERE user_id = ?
+          AND remind_at >= ?
+          AND remind_at < ?
+        ORDER BY remind_at
+        """, (user_id, start_iso, end_iso)).fetchall()
+
+def claim_dispatch(kind: str, ref_id: int, local_date: str) -> bool:
+    """
+    登記今天的通知；已經登記過（送過）時回傳 False
+    """
+    with get_conn() as conn:
+        cursor = conn.execute("""
+        INSERT OR IGNORE INTO dispatch_ledger (kind, ref_id, local_date, sent_at)
+        VALUES (?, ?, ?, ?)
+        """, (kind, ref_id, local_date, datetime.utcnow().isoformat()))
+    return cursor.rowcount == 1
+
+def release_dispatch(kind: str, ref_id: int, local_date: str):
+    """
+    發送失敗時撤銷登記，之後可以再送
+    """
+    with get_conn() as conn:
+        conn.execute("""
+        DELETE FROM dispatch_ledger
+        WHERE kind = ? AND ref_id = ? AND local_date = ?
+        """, (kind, ref_id, local_date))
+def _parse_utc(iso: str) -> datetime:
+    dt = datetime.fromisoformat(iso)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=ZoneInfo("UTC"))
+    return dt
+
+def get_fact_lines(user_id: int) -> list:
+    """
+    取得使用者的結構化事實，依重要程度由高到低排列
+    （預算不足時由後往前捨棄）
+    結果會快取，直到相關資料被寫入或列出的最早行程時間已過
+    """
+    snapshot = _fact_cache.get(user_id)
+    if snapshot is not None:
+        expires_at = snapshot["expires_at"]
+        if expires_at is None or datetime.now(ZoneInfo("UTC")) < expires_at:
+            return snapshot["lines"]
+
+    version = _cache_version(user_id)
     facts = []
-    with sqlite3.connect(DB_PATH) as conn:
+    settings = _get_settings(user_id)
+    if settings["exists"]:
+        facts.append(f"對方性別：{settings['gender']}")
+        facts.append(f"對方時區：{settings['timezone']}")
+
+    with get_conn() as conn:
         reminders = conn.execute(
             "SELECT remind_at, content FROM reminders WHERE user_id = ? AND remind_at >= ? ORDER BY remind_at LIMIT 5",
             (user_id, datetime.utcnow().isoformat())
         ).fetchall()
         for r in reminders:
-            facts.append(f"系統已排定行程：{r[0].replace('T', ' ')} - {r[1]}")
+            time_str = r[0].replace("T", " ")[:16]
+            facts.append(f"已排定行程：{time_str} - {r[1]}")
+
         annivs = conn.execute(
             "SELECT label, month, day FROM anniversaries WHERE user_id = ?",
             (user_id,)
         ).fetchall()
         for a in annivs:
             facts.append(f"重要日子 - {a[0]}：{a[1]}月{a[2]}日")
-        
-        reminders = conn.execute(
-            "SELECT remind_at, content FROM reminders WHERE user_id = ? AND remind_at >= ? ORDER BY remind_at LIMIT 5",
-            (user_id, datetime.utcnow().isoformat())
-        ).fetchall()
-        for r in reminders:
-            time_str = r[0].replace("T", " ")[:16]
-            facts.append(f"已排定行程：{time_str} - {r[1]}")
 
-        settings = conn.execute(
-            "SELECT user_gender, timezone FROM user_settings WHERE user_id = ?",
-            (user_id,)
-        ).fetchone()
-        if settings:
-            facts.append(f"對方性別：{settings[0]}")
-            facts.append(f"對方時區：{settings[1]}")
+    expires_at = None
+    if reminders:
+        try:
+            expires_at = _parse_utc(reminders[0][0])
+        except ValueError:
+            # 無法解析時間的資料不快取，下次重新查詢
+            expires_at = datetime.now(ZoneInfo("UTC"))
+
+    _cache_set(_fact_cache, user_id, version, {"lines": facts, "expires_at": expires_at})
+    return facts
+
+# 關鍵字與向量檢索各取回的候選數量（多取一些，交給 memory_ranking 評分篩選）
+RETRIEVAL_CANDIDATES = 12
+# 記憶的檢索詞有這個比例以上出現在訊息中，視為「明確提到」
+KEYWORD_CONFIDENT_COVERAGE = 0.6
+# 有這麼多條記憶被明確提到時，不再呼叫 embedding 做向量檢索
+KEYWORD_SHORT_CIRCUIT = 2
+
+_retrieval_stats = {"empty": 0, "keyword": 0, "hybrid": 0}
+
+def _keyword_search(user_id: int, terms: list, limit: int = RETRIEVAL_CANDIDATES) -> list:
+    """
+    回傳 [(id, coverage), ...]，依 bm25 排序
+    句中單獨的中日韓字（「貓 跟 狗」的「貓」）切不出 bigram，改用 LIKE 在該使用者的記憶中比對；
+    整則訊息只有一個字（「好」「嗯」）時不做比對，幾乎任何記憶都會命中
+    """
+    if not terms:
+        return []
+    query_terms = set(terms)
+    words = [t for t in query_terms if not is_single_cjk(t)]
+    chars = [t for t in query_terms if is_single_cjk(t)] if len(query_terms) > 1 else []
+
+    results = {}
+    with get_conn() as conn:
+        if words:
+            rows = conn.execute("""
+            SELECT rowid, terms
+            FROM memories_fts
+            WHERE memories_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+            """, (f'owner:"{_fts_owner(user_id)}" AND terms:({fts_query(words)})', limit)).fetchall()
+            for i, t in rows:
+                results[i] = coverage(t.split(), query_terms)
+
+        for char in chars:
+            rows = conn.execute("""
+            SELECT id, content FROM memories
+            WHERE user_id = ? AND content LIKE ?
+            ORDER BY id DESC
+            LIMIT ?
+            """, (user_id, f"%{char}%", limit)).fetchall()
+            for i, content in rows:
+                results.setdefault(i, coverage(search_terms(content), query_terms))
+
+    return list(results.items())[:limit]
+
+def _retrieve_candidates(user_id: int, query_text: str) -> list:
+    """
+    混合檢索，回傳 [{"content", "fused", "similarity", "coverage", "importance", "created_at"}, ...]：
+    1. 沒有任何記憶 → 直接回傳空列表
+    2. FTS5 關鍵字檢索；明確提到的記憶夠多時直接使用，不呼叫 embedding
+    3. 否則再做向量檢索，兩份排名以 RRF 融合
+    fused 為 0~1 的融合分數；similarity 為 cosine 相似度（向量檢索有回傳才有），
+    coverage 為關鍵字覆蓋率（關鍵字檢索有命中才有），其餘為 None
+    """
+    with get_conn() as conn:
+        if conn.execute("SELECT 1 FROM memories WHERE user_id = ? LIMIT 1", (user_id,)).fetchone() is None:
+            _retrieval_stats["empty"] += 1
+            return []
+
+    keyword = dict(_keyword_search(user_id, search_terms(query_text)))
+    confident = sum(1 for cov in keyword.values() if cov >= KEYWORD_CONFIDENT_COVERAGE)
+    keyword_ids = list(keyword)
 
-    semantic_mems = ""
-    if query_text:
+    similarity = {}
+    if confident >= KEYWORD_SHORT_CIRCUIT:
+        _retrieval_stats["keyword"] += 1
+        fused = rrf_fuse(keyword_ids)
+    else:
+        _retrieval_stats["hybrid"] += 1
         try:
-            results = collection.query(
-                query_texts=[query_text],
-                n_results=3,
-                where={"user_id": user_id}
-            )
-            if results['documents'] and results['documents'][0]:
-                semantic_mems = "\n".join([f"往事片段：{d}" for d in results['documents'][0]])
+            matches = vector_store.query(user_id, embedder.embed([query_text], persist=False)[0], RETRIEVAL_CANDIDATES)
         except Exception as e:
-            print(f"ChromaDB 查詢失敗: {e}")
+            print(f"向量檢索失敗: {e}")
+            matches = []
+        similarity = {memory_id: sim for memory_id, _, sim in matches}
+        fused = rrf_fuse(keyword_ids, list(similarity))
+
+    if not fused:
+        return []
+
+    placeholders = ",".join("?" * len(fused))
+    with get_conn() as conn:
+        rows = conn.execute(f"""
+        SELECT id, content, importance, created_at FROM memories
+        WHERE id IN ({placeholders})
+        """, list(fused)).fetchall()
+
+    return [
+        {
+            "content": content,
+            "fused": fused[i],
+            "similarity": similarity.get(i),
+            "coverage": keyword.get(i),
+            "importance": importance,
+            "created_at": created_at,
+        }
+        for i, content, importance, created_at in rows
+    ]
 
-    fact_str = "\n".join(facts)
+def get_retrieval_stats() -> dict:
+    total = sum(_retrieval_stats.values())
+    return {
+        **_retrieval_stats,
+        "embedding_skipped_rate": (total - _retrieval_stats["hybrid"]) / total if total else 0.0,
+    }
+
+def get_semantic_memory_lines(user_id: int, query_text: str, limit: int = MAX_MEMORIES) -> list:
+    """
+    取得與當前話題相關的回憶（依相關程度、重要性與新鮮度排序）
+    不相關的記憶不會放進來，因此可能少於 limit 條，甚至沒有
+    """
+    if not query_text:
+        return []
+    try:
+        return rank_memories(
+            _retrieve_candidates(user_id, query_text),
+            lambda content: f"往事片段：{content}",
+            max_items=limit,
+        )
+    except Exception as e:
+        print(f"記憶檢索失敗: {e}")
+    return []
+
+def format_facts(fact_lines: list, memory_lines: list) -> str:
+    fact_str = "\n".join(fact_lines)
+    semantic_mems = "\n".join(memory_lines)
     return f"【已知事實】\n{fact_str}\n\n【相關回憶】\n{semantic_mems}"
 
+def get_all_facts(user_id: int, query_text: str = None):
+    return format_facts(
+        get_fact_lines(user_id),
+        get_semantic_memory_lines(user_id, query_text)
+    )
+
 def delete_reminder_by_index(user_id: int, index: int) -> bool:
     """
     依照使用者目前行程排序後的「第 index 筆」刪除
     index 從 1 開始
     """
-    import sqlite3
-    from .memory_manager import DB_PATH 
-
-    with sqlite3.connect(DB_PATH) as conn:
+    with get_conn() as conn:
         rows = conn.execute("""
             SELECT id
             FROM reminders
@@ -329,4 +1074,5 @@ def delete_reminder_by_index(user_id: int, index: int) -> bool:
             "DELETE FROM reminders WHERE id = ?",
             (reminder_id,)
         )
-        return True
\ No newline at end of file
+    invalidate_facts(user_id)
+    return True
\ No newline at end of file
@@ -0,0 +1,81 @@
+import math
+from datetime import datetime
+
+from .context_manager import count_tokens
+
+# cosine 相似度低於此值的記憶直接捨棄，不論多重要
+MIN_RELEVANCE = 0.5
+# 沒有 cosine 相似度（向量檢索沒有回傳）的關鍵字命中，覆蓋率低於此值也捨棄；
+# FTS 只要共用一個常見 bigram（「喜歡」）就算命中，不能單靠命中與否判斷
+MIN_COVERAGE = 0.5
+# 記憶的新鮮度每隔這麼多天減半
+RECENCY_HALF_LIFE_DAYS = 30
+# importance 達到此值即視為滿分
+IMPORTANCE_CAP = 5
+
+# 綜合分數的權重：相關程度為主，重要性與新鮮度用來排序相近的候選
+# （RRF 融合分數在 12 名內只從 1.0 降到約 0.85，區分度不足，只用來排序同分的候選）
+RELEVANCE_WEIGHT = 0.7
+IMPORTANCE_WEIGHT = 0.2
+RECENCY_WEIGHT = 0.1
+
+# 每輪最多放幾條回憶、最多用多少 token
+MAX_MEMORIES = 5
+MEMORY_TOKEN_CAP = 200
+
+
+def recency(created_at: str, now: datetime) -> float:
+    try:
+        age_days = (now - datetime.fromisoformat(created_at)).total_seconds() / 86400
+    except (TypeError, ValueError):
+        return 0.0
+    return math.exp(-math.log(2) * max(age_days, 0) / RECENCY_HALF_LIFE_DAYS)
+
+
+def relevance(candidate: dict) -> float:
+    """
+    有 cosine 相似度時以它為準，否則使用關鍵字覆蓋率
+    """
+    if candidate["similarity"] is not None:
+        return candidate["similarity"]
+    return candidate["coverage"] or 0.0
+
+
+def is_relevant(candidate: dict) -> bool:
+    if candidate["similarity"] is not None:
+        return candidate["similarity"] >= MIN_RELEVANCE
+    return relevance(candidate) >= MIN_COVERAGE
+
+
+def score(candidate: dict, now: datetime) -> float:
+    importance = min(max(candidate["importance"] or 1, 1), IMPORTANCE_CAP) / IMPORTANCE_CAP
+    return (
+        RELEVANCE_WEIGHT * relevance(candidate)
+        + IMPORTANCE_WEIGHT * importance
+        + RECENCY_WEIGHT * recency(candidate["created_at"], now)
+    )
+
+
+def rank_memories(candidates: list, format_line, now: datetime = None,
+                  max_items: int = MAX_MEMORIES, max_tokens: int = MEMORY_TOKEN_CAP) -> list:
+    """
+    candidates：[{"content", "fused", "similarity", "coverage", "importance", "created_at"}, ...]
+    捨棄不相關的候選後依綜合分數排序，在數量與 token 上限內盡量多放，
+    回傳格式化後的文字列（可能為空）
+    """
+    now = now or datetime.utcnow()
+    relevant = [c for c in candidates if is_relevant(c)]
+    relevant.sort(key=lambda c: (score(c, now), c["fused"]), reverse=True)
+
+    lines = []
+    used = 0
+    for candidate in relevant:
+        line = format_line(candidate["content"])
+        cost = count_tokens(line)
+        if used + cost > max_tokens:
+            continue
+        lines.append(line)
+        used += cost
+        if len(lines) >= max_items:
+            break
+    return lines
@@ -0,0 +1,192 @@
+import argparse
+import hashlib
+import threading
+
+import numpy as np
+
+from .database import get_conn
+
+# 舊版所有使用者共用的 collection
+LEGACY_COLLECTION = "user_memories"
+# 一般使用者依 user_id 雜湊分到這麼多個 collection
+SHARD_COUNT = 16
+# 記憶數量超過此值的使用者搬到自己專屬的 collection
+# 每晚整理會把記憶數量壓回 memory_consolidation.MAX_MEMORIES_PER_USER（200），此值必須比它小
+DEDICATED_THRESHOLD = 150
+# 搬移舊資料時每批讀取的筆數
+MIGRATE_BATCH_SIZE = 500
+
+
+def shard_name(user_id: int) -> str:
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return f"user_memories_{int.from_bytes(digest, 'big') % SHARD_COUNT:02d}"
+
+
+def dedicated_name(user_id: int) -> str:
+    return f"user_memories_u{user_id}"
+
+
+def unit_vectors(embeddings) -> list:
+    """
+    查詢時以 1 - d / 2 換算 cosine，存進 collection 的向量必須是單位向量；
+    舊版直接寫入的向量沒有正規化，搬移時順便修正
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return (vectors / np.where(norms == 0, 1, norms)).tolist()
+
+
+def _names(client) -> set:
+    # 新版 Chroma 回傳名稱，舊版回傳 Collection 物件
+    return {getattr(c, "name", c) for c in client.list_collections()}
+
+
+class ShardRouter:
+    """
+    依使用者決定記憶存在哪個 Chroma collection：
+    一般使用者雜湊分片，記憶很多的使用者使用專屬 collection（記錄於 memory_shards 表）。
+    查詢成本只與同一分片（或使用者自己）的記憶量有關，不再隨全體使用者成長
+    """
+
+    def __init__(self, client, embedding_function=None, connect=get_conn):
+        self._client = client
+        self._connect = connect
+        self._embedding_function = embedding_function
+        self._collections = {}
+        self._dedicated = None
+        self._lock = threading.Lock()
+
+    def _collection(self, name: str):
+        with self._lock:
+            collection = self._collections.get(name)
+            if collection is None:
+                collection = self._client.get_or_create_collection(
+                    name=name,
+                    embedding_function=self._embedding_function
+                )
+                self._collections[name] = collection
+            return collection
+
+    def _dedicated_map(self) -> dict:
+        if self._dedicated is None:
+            with self._connect() as conn:
+                rows = conn.execute("SELECT user_id, collection FROM memory_shards").fetchall()
+            self._dedicated = dict(rows)
+        return self._dedicated
+
+    def name_for(self, user_id: int) -> str:
+        return self._dedicated_map().get(user_id) or shard_name(user_id)
+
+    def collection_for(self, user_id: int):
+        return self._collection(self.name_for(user_id))
+
+    def is_dedicated(self, user_id: int) -> bool:
+        return user_id in self._dedicated_map()
+
+    def promote(self, user_id: int) -> int:
+        """
+        把使用者的記憶從共用分片搬到專屬 collection，回傳搬移筆數
+        先寫入新位置並記錄路由，最後才刪除舊資料；中途失敗不會遺失記憶
+        """
+        if self.is_dedicated(user_id):
+            return 0
+
+        source = self.collection_for(user_id)
+        target = self._collection(dedicated_name(user_id))
+        data = source.get(
+            where={"user_id": user_id},
+            include=["documents", "embeddings", "metadatas"]
+        )
+        if data["ids"]:
+            target.upsert(
+                ids=data["ids"],
+                documents=data["documents"],
+                embeddings=unit_vectors(data["embeddings"]),
+                metadatas=data["metadatas"]
+            )
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO memory_shards (user_id, collection) VALUES (?, ?)",
+                (user_id, dedicated_name(user_id))
+            )
+        self._dedicated_map()[user_id] = dedicated_name(user_id)
+
+        if data["ids"]:
+            source.delete(ids=data["ids"])
+        return len(data["ids"])
+
+    def has_legacy_data(self) -> bool:
+        return LEGACY_COLLECTION in _names(self._client)
+
+    def migrate_legacy(self, drop: bool = False) -> int:
+        """
+        把舊的 user_memories 拆分到各分片（重複執行也安全：使用 upsert）
+        """
+        if not self.has_legacy_data():
+            return 0
+
+        legacy = self._client.get_collection(name=LEGACY_COLLECTION)
+        moved = 0
+        offset = 0
+        while True:
+            data = legacy.get(
+                include=["documents", "embeddings", "metadatas"],
+                limit=MIGRATE_BATCH_SIZE,
+                offset=offset
+            )
+            if not data["ids"]:
+                break
+
+            routed = {}
+            for i, memory_id in enumerate(data["ids"]):
+                user_id = data["metadatas"][i]["user_id"]
+                batch = routed.setdefault(self.name_for(user_id), {
+                    "ids": [], "documents": [], "embeddings": [], "metadatas": []
+                })
+                batch["ids"].append(memory_id)
+                batch["documents"].append(data["documents"][i])
+                batch["embeddings"].append(data["embeddings"][i])
+                batch["metadatas"].append(data["metadatas"][i])
+
+            for name, batch in routed.items():
+                batch["embeddings"] = unit_vectors(batch["embeddings"])
+                self._collection(name).upsert(**batch)
+
+            moved += len(data["ids"])
+            offset += len(data["ids"])
+            print(f"已搬移 {moved} 筆記憶")
+
+        if drop:
+            self._client.delete_collection(name=LEGACY_COLLECTION)
+        return moved
+
+
+def main():
+    # python -m bot_core.memory_shards [--drop]
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    from .memory_manager import init_db, vector_store, get_users_with_memories_over
+
+    parser = argparse.ArgumentParser(description="把舊的 user_memories collection 拆分到分片")
+    parser.add_argument("--drop", action="store_true", help="搬移完成後刪除舊的 collection")
+    args = parser.parse_args()
+
+    if vector_store.name != "chroma":
+        print(f"目前的向量後端是 {vector_store.name}，不需要拆分 Chroma collection")
+        return
+
+    init_db()
+    shards = vector_store.shards
+    moved = shards.migrate_legacy(drop=args.drop)
+    promoted = 0
+    for user_id in get_users_with_memories_over(DEDICATED_THRESHOLD):
+        if not shards.is_dedicated(user_id):
+            shards.promote(user_id)
+            promoted += 1
+    print(f"完成：搬移 {moved} 筆記憶，{promoted} 位使用者改用專屬 collection")
+
+
+if __name__ == "__main__":
+    main()
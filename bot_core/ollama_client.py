@@ -0,0 +1,95 @@
+import json
+from typing import Optional, AsyncIterator
+
+import aiohttp
+
+OLLAMA_HOST = "http://localhost:11434"
+OLLAMA_CHAT_URL = f"{OLLAMA_HOST}/api/chat"
+EMBED_MODEL = "bge-m3"
+
+# 連線池設定：Ollama 本身同時能處理的請求有限，多開連線只會在伺服器端排隊
+POOL_SIZE = 4
+KEEPALIVE_SECONDS = 120
+
+# 模型在 Ollama 常駐的時間；過期被卸載後，下次請求要重新載入並重算整段 prompt
+MODEL_KEEP_ALIVE = "30m"
+
+_session: Optional[aiohttp.ClientSession] = None
+_embed_client = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    取得共用的 aiohttp session（需在 event loop 內呼叫）
+    所有 LLM 請求共用同一個連線池，避免每次重新建立 TCP 連線
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=POOL_SIZE,
+            keepalive_timeout=KEEPALIVE_SECONDS,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def post_chat(payload: dict, timeout: float = 30) -> dict:
+    """
+    呼叫 Ollama /api/chat（非串流）
+    timeout 為整個請求的上限秒數；呼叫端的 task 被取消時請求也會一併中止
+    """
+    session = get_session()
+    async with session.post(
+        OLLAMA_CHAT_URL,
+        json={"keep_alive": MODEL_KEEP_ALIVE, **payload},
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as response:
+        response.raise_for_status()
+        return await response.json()
+
+
+async def chat_content(payload: dict, timeout: float = 30) -> str:
+    data = await post_chat(payload, timeout=timeout)
+    return data["message"]["content"]
+
+
+
+async def stream_chat(payload: dict, timeout: float = 60) -> AsyncIterator[dict]:
+    """
+    呼叫 Ollama /api/chat（串流），逐行 yield 解析後的 JSON 片段
+    timeout 為兩個片段之間的最長等待秒數，而非整體上限
+    """
+    session = get_session()
+    async with session.post(
+        OLLAMA_CHAT_URL,
+        json={"keep_alive": MODEL_KEEP_ALIVE, **payload, "stream": True},
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=timeout),
+    ) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            line = line.strip()
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"])
+            yield chunk
+
+
+def embed_texts(texts: list, model: str = EMBED_MODEL) -> list:
+    """
+    同步取得 embedding（在背景執行緒呼叫）；整批文字只送一次請求
+    不依賴 chromadb，使用 NumPy 向量後端時不必載入它
+    """
+    global _embed_client
+    if _embed_client is None:
+        import ollama
+        _embed_client = ollama.Client(host=OLLAMA_HOST)
+    return _embed_client.embed(model=model, input=texts, keep_alive=MODEL_KEEP_ALIVE)["embeddings"]
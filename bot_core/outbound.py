@@ -0,0 +1,152 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+
+import discord
+
+# 優先權：數字越小越先送；互動回覆永遠排在大量通知前面
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Discord 全域限制約每秒 50 次請求，保留一些餘裕給其他 API 呼叫
+DEFAULT_RATE = 40
+DEFAULT_BURST = 10
+DEFAULT_WORKERS = 8
+
+# 統計最近多少筆的送出延遲
+LATENCY_WINDOW = 500
+
+
+class TokenBucket:
+    """
+    令牌桶限流；收到 429 或剩餘額度歸零時依回應標頭暫停
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._updated) * self.rate,
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _retry_after(error: discord.HTTPException):
+    """
+    從 Discord 回應標頭取出需要等待的秒數；沒有限流資訊時回傳 None
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+
+    if error.status == 429:
+        value = headers.get("Retry-After") or headers.get("X-RateLimit-Reset-After")
+        return float(value) if value else 1.0
+    if headers.get("X-RateLimit-Remaining") == "0":
+        value = headers.get("X-RateLimit-Reset-After")
+        return float(value) if value else None
+    return None
+
+
+class OutboundQueue:
+    """
+    所有對 Discord 的送出（私訊、回覆、編輯）都經過這裡：
+    依優先權排隊，由固定數量的 sender 在令牌桶限制下並行送出
+    """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self._workers = workers
+        self._bucket = TokenBucket(rate, burst)
+        self._queue = None
+        self._tasks = []
+        self._seq = itertools.count()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.sent = 0
+        self.failed = 0
+
+    def is_running(self) -> bool:
+        return bool(self._tasks)
+
+    def start(self):
+        if self.is_running():
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._tasks = [
+            asyncio.create_task(self._sender(), name=f"outbound-{i}")
+            for i in range(self._workers)
+        ]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def submit(self, send, priority: int = PRIORITY_BULK):
+        """
+        send：不帶參數、回傳 coroutine 的函式（例如 lambda: channel.send(...)）
+        等到實際送出後回傳結果，送出失敗時拋出原本的例外
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), time.monotonic(), send, future))
+        return await future
+
+    async def _sender(self):
+        while True:
+            _, _, enqueued, send, future = await self._queue.get()
+            try:
+                if future.cancelled():
+                    continue
+
+                await self._bucket.acquire()
+                try:
+                    result = await send()
+                except discord.HTTPException as e:
+                    wait = _retry_after(e)
+                    if wait:
+                        self._bucket.pause(wait)
+                    self.failed += 1
+                    if not future.cancelled():
+                        future.set_exception(e)
+                except Exception as e:
+                    self.failed += 1
+                    if not future.cancelled():
+                        future.set_exception(e)
+                else:
+                    self.sent += 1
+                    if not future.cancelled():
+                        future.set_result(result)
+
+                self._latencies.append(time.monotonic() - enqueued)
+            finally:
+                self._queue.task_done()
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        return {
+            "depth": self._queue.qsize() if self._queue else 0,
+            "sent": self.sent,
+            "failed": self.failed,
+            "latency_avg": sum(latencies) / len(latencies) if latencies else 0.0,
+            "latency_p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+        }
@@ -0,0 +1,107 @@
+import asyncio
+import heapq
+import time
+from typing import Awaitable, Callable, Optional
+
+# 最長睡眠時間：即使沒有任何排程，也會定期醒來重新從資料庫同步一次，
+# 以免漏掉不是透過 schedule() 新增的資料
+DEFAULT_RESYNC_SECONDS = 3600
+
+# 事件迴圈的計時器可能提早幾毫秒醒來，多睡一點避免空轉
+WAKE_SLACK_SECONDS = 0.01
+
+
+class DeadlineScheduler:
+    """
+    以 min-heap 保存 (到期時間, key)，單一迴圈睡到最早的期限為止。
+    新增更早的期限時立即喚醒重新計算，不需要輪詢。
+
+    on_due(keys)：期限已到的 key 列表（async）
+    load()：回傳 [(timestamp, key), ...]，啟動與定期同步時用來重建 heap
+    """
+
+    def __init__(
+        self,
+        on_due: Callable[[list], Awaitable[None]],
+        load: Optional[Callable[[], list]] = None,
+        resync_seconds: float = DEFAULT_RESYNC_SECONDS,
+        name: str = "scheduler",
+    ):
+        self._on_due = on_due
+        self._load = load
+        self._resync_seconds = resync_seconds
+        self._name = name
+        self._heap = []
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self._next_resync = 0.0
+
+    def is_running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.is_running():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(), name=self._name)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, when: float, key):
+        """
+        新增一個期限（Unix timestamp）；可從任何執行緒呼叫
+        """
+        if self._loop is None:
+            # 尚未啟動：啟動時會由 load() 重新載入
+            return
+        self._loop.call_soon_threadsafe(self._push, when, key)
+
+    def _push(self, when: float, key):
+        heapq.heappush(self._heap, (when, key))
+        if self._heap[0] == (when, key):
+            self._wakeup.set()
+
+    def _resync(self):
+        if self._load is None:
+            return
+        entries = list(self._load())
+        heapq.heapify(entries)
+        self._heap = entries
+        self._next_resync = time.time() + self._resync_seconds
+
+    async def _run(self):
+        self._resync()
+
+        while True:
+            now = time.time()
+            if self._load is not None and now >= self._next_resync:
+                self._resync()
+
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[1])
+
+            if due:
+                try:
+                    await self._on_due(due)
+                except Exception as e:
+                    print(f"{self._name} 執行失敗:", e)
+                continue
+
+            timeout = self._next_resync - now if self._load is not None else self._resync_seconds
+            if self._heap:
+                timeout = min(timeout, self._heap[0][0] - now)
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0) + WAKE_SLACK_SECONDS)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,66 @@
+import re
+
+from .embedding_cache import normalize_text
+
+# 中日韓文字沒有空白分詞，以相鄰兩字（bigram）作為檢索詞；英數字以整個單字為一詞
+_TERM = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]+|[a-z0-9]+")
+_CJK = re.compile(r"[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]")
+# Reciprocal Rank Fusion 的平滑常數（論文建議值）
+RRF_K = 60
+
+
+def search_terms(text: str) -> list:
+    """
+    「我喜歡貓 cat」→ ["我喜", "喜歡", "歡貓", "cat"]
+    寫入 FTS5 索引與查詢時使用同一套切法
+    """
+    terms = []
+    for run in _TERM.findall(normalize_text(text)):
+        if _CJK.match(run) and len(run) > 1:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run)
+    return terms
+
+
+def is_single_cjk(term: str) -> bool:
+    """
+    只有一個中日韓字的詞（FTS5 索引裡只有 bigram，無法直接比對）
+    """
+    return len(term) == 1 and _CJK.match(term) is not None
+
+
+def fts_query(terms) -> str:
+    """
+    組成 FTS5 MATCH 字串（任一詞命中即可，排序交給 bm25）
+    """
+    return " OR ".join(f'"{t}"' for t in dict.fromkeys(terms))
+
+
+def coverage(memory_terms: list, query_terms: set) -> float:
+    """
+    記憶的檢索詞有多少比例出現在查詢中；1.0 代表整條記憶都被提到了
+    查詢中的單一中日韓字視為命中所有包含該字的 bigram
+    """
+    if not memory_terms:
+        return 0.0
+    chars = {t for t in query_terms if is_single_cjk(t)}
+    return sum(
+        1 for t in memory_terms
+        if t in query_terms or (chars and any(c in t for c in chars))
+    ) / len(memory_terms)
+
+
+def rrf_fuse(*rankings, k: int = RRF_K) -> dict:
+    """
+    合併多個依相關程度排序的 id 列表，回傳 {id: 融合分數}（由高到低）
+    分數除以「在每個列表都排第一」的理論最大值，落在 0~1 之間
+    """
+    if not rankings:
+        return {}
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    best = len(rankings) / (k + 1)
+    return {item: scores[item] / best for item in sorted(scores, key=scores.get, reverse=True)}
@@ -0,0 +1,349 @@
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from .cache import LRUCache
+from .database import get_conn
+from .memory_shards import unit_vectors
+
+CHROMA_PATH = "data/vector_db"
+# 向量矩陣快取保留幾位使用者（每位約 記憶數 × 1024 × 4 bytes）
+MATRIX_CACHE_USERS = 256
+
+
+class VectorStore(ABC):
+    """
+    長期記憶的向量儲存介面；memory_manager 只透過這幾個方法存取向量
+
+    query 回傳 [(memory_id, document, similarity), ...]，similarity 為 cosine 相似度，由高到低排列
+    """
+
+    name = ""
+
+    @abstractmethod
+    def upsert(self, user_id: int, memory_ids: list, documents: list, embeddings, categories: list):
+        ...
+
+    @abstractmethod
+    def query(self, user_id: int, embedding, limit: int) -> list:
+        ...
+
+    @abstractmethod
+    def delete(self, user_id: int, memory_ids: list):
+        ...
+
+    def after_write(self, user_id: int, memory_count: int):
+        """寫入後的維護（例如搬到專屬分片）；預設不做事"""
+
+    def check(self):
+        """啟動時的檢查；預設不做事"""
+
+
+class ChromaVectorStore(VectorStore):
+    """
+    以 Chroma 儲存，依使用者分片（見 memory_shards）
+    chromadb 只在選用此後端時才載入
+    """
+
+    name = "chroma"
+
+    def __init__(self, path: str = CHROMA_PATH, connect=get_conn):
+        import chromadb
+        from chromadb.utils import embedding_functions
+        from .memory_shards import ShardRouter
+
+        # 寫入與查詢一律直接給向量；embedding function 只用來維持 collection 原本的設定
+        ollama_ef = embedding_functions.OllamaEmbeddingFunction(
+            url="http://localhost:11434/api/embeddings",
+            model_name="bge-m3"
+        )
+        self.shards = ShardRouter(
+            chromadb.PersistentClient(path=path), embedding_function=ollama_ef, connect=connect
+        )
+
+    def upsert(self, user_id, memory_ids, documents, embeddings, categories):
+        self.shards.collection_for(user_id).upsert(
+            documents=documents,
+            embeddings=unit_vectors(embeddings),
+            ids=[f"mem_{i}" for i in memory_ids],
+            metadatas=[{"user_id": user_id, "category": c} for c in categories]
+        )
+
+    def query(self, user_id, embedding, limit):
+        # 下面的距離換算假設查詢向量也是單位向量
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        results = self.shards.collection_for(user_id).query(
+            query_embeddings=[query.tolist()],
+            n_results=limit,
+            where={"user_id": user_id}
+        )
+        if not results["ids"] or not results["ids"][0]:
+            return []
+        # collection 使用預設的 L2（平方）距離；寫入與搬移時都已正規化，cosine = 1 - d / 2
+        return [
+            (int(i.removeprefix("mem_")), d, 1 - distance / 2)
+            for i, d, distance in zip(
+                results["ids"][0], results["documents"][0], results["distances"][0]
+            )
+        ]
+
+    def delete(self, user_id, memory_ids):
+        self.shards.collection_for(user_id).delete(ids=[f"mem_{i}" for i in memory_ids])
+
+    def after_write(self, user_id, memory_count):
+        from .memory_shards import DEDICATED_THRESHOLD
+
+        if memory_count <= DEDICATED_THRESHOLD or self.shards.is_dedicated(user_id):
+            return
+        try:
+            moved = self.shards.promote(user_id)
+            print(f"使用者 {user_id} 的 {moved} 條記憶已改用專屬 collection")
+        except Exception as e:
+            print(f"⚠️ 記憶分片搬移失敗 {user_id}: {e}")
+
+    def check(self):
+        if self.shards.has_legacy_data():
+            print("⚠️ 偵測到舊的 user_memories collection，請執行 python -m bot_core.memory_shards 拆分到分片")
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    向量以 float32 BLOB 存在 memories.embedding，查詢時對使用者的整個矩陣做一次
+    矩陣乘法算 cosine。每位使用者通常只有幾百條記憶，暴力搜尋只需不到一毫秒，
+    也不必載入 chromadb
+    """
+
+    name = "numpy"
+
+    def __init__(self, cache_users: int = MATRIX_CACHE_USERS, connect=get_conn):
+        # {user_id: (ids, 正規化後的矩陣, documents)}
+        self._matrices = LRUCache(cache_users)
+        self._connect = connect
+
+    def _load(self, user_id: int):
+        entry = self._matrices.get(user_id)
+        if entry is not None:
+            return entry
+
+        with self._connect() as conn:
+            rows = conn.execute("""
+            SELECT id, content, embedding FROM memories
+            WHERE user_id = ? AND embedding IS NOT NULL
+            ORDER BY id
+            """, (user_id,)).fetchall()
+
+        if rows:
+            matrix = np.stack([np.frombuffer(r[2], dtype=np.float32) for r in rows])
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.where(norms == 0, 1, norms)
+        else:
+            matrix = np.empty((0, 0), dtype=np.float32)
+
+        entry = (np.array([r[0] for r in rows], dtype=np.int64), matrix, [r[1] for r in rows])
+        self._matrices.set(user_id, entry)
+        return entry
+
+    def upsert(self, user_id, memory_ids, documents, embeddings, categories):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE memories SET embedding = ? WHERE id = ?",
+                [(vector.tobytes(), memory_id) for memory_id, vector in zip(memory_ids, vectors)]
+            )
+        self._matrices.pop(user_id)
+
+    def query(self, user_id, embedding, limit):
+        ids, matrix, documents = self._load(user_id)
+        if not len(ids):
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+        similarity = matrix @ query
+
+        if limit < len(ids):
+            top = np.argpartition(-similarity, limit)[:limit]
+        else:
+            top = np.arange(len(ids))
+        top = top[np.argsort(-similarity[top])]
+        return [(int(ids[i]), documents[i], float(similarity[i])) for i in top]
+
+    def delete(self, user_id, memory_ids):
+        # 資料列由呼叫端從 memories 刪除，這裡只需讓快取失效
+        self._matrices.pop(user_id)
+
+    def _missing(self) -> list:
+        with self._connect() as conn:
+            return conn.execute("""
+            SELECT id, user_id, content FROM memories
+            WHERE indexed = 1 AND embedding IS NULL
+            ORDER BY id
+            """).fetchall()
+
+    def check(self):
+        missing = self._missing()
+        if missing:
+            print(f"⚠️ 有 {len(missing)} 條記憶尚未存入向量，請執行 python -m bot_core.vector_store backfill")
+
+    def backfill(self, embed, batch_size: int = 64) -> int:
+        """
+        從 Chroma 切換過來時，替既有記憶補上 embedding（大多會命中 embedding 快取）
+        """
+        missing = self._missing()
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start:start + batch_size]
+            vectors = np.asarray(embed([r[2] for r in batch]), dtype=np.float32)
+            with self._connect() as conn:
+                conn.executemany(
+                    "UPDATE memories SET embedding = ? WHERE id = ?",
+                    [(vector.tobytes(), r[0]) for r, vector in zip(batch, vectors)]
+                )
+            for user_id in {r[1] for r in batch}:
+                self._matrices.pop(user_id)
+            print(f"已補上 {min(start + batch_size, len(missing))}/{len(missing)} 條")
+        return len(missing)
+
+    def stats(self) -> dict:
+        return self._matrices.stats()
+
+
+BACKENDS = {
+    ChromaVectorStore.name: ChromaVectorStore,
+    NumpyVectorStore.name: NumpyVectorStore,
+}
+
+
+def create_vector_store(name: str) -> VectorStore:
+    if name not in BACKENDS:
+        raise ValueError(f"未知的向量後端：{name}（可用：{', '.join(BACKENDS)}）")
+    return BACKENDS[name]()
+
+
+# ======================
+# 維護工具與效能比較
+# python -m bot_core.vector_store backfill
+# python -m bot_core.vector_store benchmark [--users 50 --memories 300]
+# ======================
+def _import_seconds(module: str) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+    return time.perf_counter() - start
+
+
+def _percentile(values: list, ratio: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+def benchmark(users: int, memories: int, dim: int, queries: int, limit: int = 3):
+    """
+    以隨機向量在暫存資料夾比較兩個後端的寫入時間與查詢延遲
+    """
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # 使用獨立的連線，不影響 database 模組的全域設定與其他執行緒的連線
+        bench_conn = sqlite3.connect(os.path.join(tmp, "bench.db"))
+        connect = lambda: bench_conn
+        with bench_conn as conn:
+            conn.executescript("""
+            CREATE TABLE memories (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                indexed INTEGER NOT NULL DEFAULT 1,
+                embedding BLOB
+            );
+            CREATE INDEX idx_memories_user ON memories (user_id);
+            CREATE TABLE memory_shards (user_id INTEGER PRIMARY KEY, collection TEXT NOT NULL);
+            """)
+            conn.executemany(
+                "INSERT INTO memories (id, user_id, content) VALUES (?, ?, ?)",
+                [(u * memories + m, u, f"記憶 {u}-{m}") for u in range(users) for m in range(memories)]
+            )
+
+        data = {
+            u: rng.standard_normal((memories, dim)).astype(np.float32)
+            for u in range(users)
+        }
+        probes = [
+            (int(u), rng.standard_normal(dim).astype(np.float32))
+            for u in rng.integers(0, users, queries)
+        ]
+
+        results = {}
+        for name, factory in (
+            ("numpy", lambda: NumpyVectorStore(connect=connect)),
+            ("chroma", lambda: ChromaVectorStore(path=os.path.join(tmp, "chroma"), connect=connect)),
+        ):
+            try:
+                store = factory()
+            except ImportError as e:
+                print(f"略過 {name}：{e}")
+                continue
+
+            start = time.perf_counter()
+            for u, matrix in data.items():
+                ids = list(range(u * memories, (u + 1) * memories))
+                store.upsert(u, ids, [f"記憶 {i}" for i in ids], matrix, ["偏好"] * memories)
+            write_seconds = time.perf_counter() - start
+
+            latencies = []
+            for u, probe in probes:
+                start = time.perf_counter()
+                store.query(u, probe, limit)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+            results[name] = {
+                "import_s": _import_seconds("numpy" if name == "numpy" else "chromadb"),
+                "write_s": write_seconds,
+                "query_p50_ms": _percentile(latencies, 0.5),
+                "query_p95_ms": _percentile(latencies, 0.95),
+            }
+        bench_conn.close()
+
+    print(f"{users} 位使用者 × {memories} 條記憶，{dim} 維，{queries} 次查詢（top {limit}）")
+    for name, r in results.items():
+        print(
+            f"{name:>6}  import {r['import_s']:.2f}s  寫入 {r['write_s']:.2f}s  "
+            f"查詢 p50 {r['query_p50_ms']:.2f}ms  p95 {r['query_p95_ms']:.2f}ms"
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="向量後端維護工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backfill", help="替既有記憶補上 NumPy 後端使用的 embedding")
+    bench = sub.add_parser("benchmark", help="比較 numpy 與 chroma 後端")
+    bench.add_argument("--users", type=int, default=50)
+    bench.add_argument("--memories", type=int, default=300)
+    bench.add_argument("--dim", type=int, default=1024)
+    bench.add_argument("--queries", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args.users, args.memories, args.dim, args.queries)
+        return
+
+    from dotenv import load_dotenv
+
+    # 讀取 .env 的 VECTOR_BACKEND，memory_manager 才不會用預設的 chroma 初始化
+    load_dotenv()
+    from .memory_manager import init_db, embedder
+
+    init_db()
+    store = NumpyVectorStore()
+    print(f"完成：補上 {store.backfill(embedder.embed)} 條記憶的 embedding")
+
+
+if __name__ == "__main__":
+    main()
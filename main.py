@@ -2,62 +2,140 @@ import os
 import re
 import asyncio
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
 from datetime import timedelta
 from datetime import datetime
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
-from bot_core.llm_service import parse_reminder_intent
-from bot_core.llm_service import parse_delete_intent
+
+# bot_core 在 import 時就會讀取環境變數（例如 VECTOR_BACKEND），必須先載入 .env
+load_dotenv()
+
+from bot_core.llm_service import extract_message_intents
 from bot_core.memory_manager import get_reminders, delete_reminder_by_index
 
 
 from bot_core.schedule_renderer import render_schedule
-from bot_core.llm_service import generate_response, should_store_memory
+from bot_core.llm_service import stream_response, get_prompt_stats
+from bot_core.intent_rules import get_fast_path_stats
+from bot_core.ollama_client import close_session
+from bot_core.database import close_all as close_db
+from bot_core.scheduler import DeadlineScheduler
+from bot_core.daily_dispatch import DailyZoneDispatcher
+from bot_core.dm_resolver import DMResolver
+from bot_core.outbound import OutboundQueue, PRIORITY_INTERACTIVE, PRIORITY_BULK
+from bot_core.memory_ingest import MemoryIngestor
+from bot_core.memory_consolidation import consolidate_all
+from bot_core.history_store import HistoryStore
 from bot_core.memory_manager import (
-    get_all_anniversaries_with_tz,
+    get_anniversaries_on,
     init_db,
     save_memory,
+    add_memory_listener,
+    get_unindexed_memory_ids,
+    index_memories,
     set_user_role,
     set_user_gender,
     set_user_timezone,
     get_user_timezone,
     save_reminder,
     get_reminders,
-    pop_due_reminders,
+    claim_due_reminders,
+    ack_reminders,
+    release_reminder,
+    get_pending_reminder_times,
+    add_reminder_listener,
+    save_short_reminder,
+    get_pending_short_reminder_times,
+    pop_short_reminders,
+    cancel_short_reminder,
     get_user_role,
     save_anniversary,
-    get_anniversaries,
     get_today_reminders,
     get_week_reminders,
-    get_all_anniversaries,
+    get_user_timezones,
+    get_users_with_reminders_between,
+    get_reminders_between,
+    claim_dispatch,
+    release_dispatch,
+    get_settings_cache_stats,
+    get_embedding_cache_stats,
+    get_retrieval_stats,
 )
-short_reminder_tasks = {}  
-# 格式：
-# { user_id: [ { "content": str, "task": asyncio.Task } ] }
 
 # ======================
 # 環境設定
 # ======================
-load_dotenv()
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 print("TOKEN 是否存在：", bool(TOKEN))
-user_history = {} # 格式: {user_id: [message1, message2, ...]}
+
+# 串流回覆時編輯訊息的最短間隔（Discord 同一頻道約每 5 秒 5 次編輯）
+STREAM_EDIT_INTERVAL = 1.2
+DISCORD_MESSAGE_LIMIT = 2000
+# 每位使用者保留的歷史訊息上限；實際送進模型多少由 context_manager 依 token 預算決定
+HISTORY_LIMIT = 40
 
 # ======================
 # Discord 設定
 # ======================
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="%", intents=intents)
 
-def split_into_clauses(text: str):
-    return [
-        t.strip()
-        for t in re.split(r"[，,、]", text)
-        if t.strip()
-    ]
+
+class LoverBot(commands.Bot):
+    async def setup_hook(self):
+        # 送出佇列要在收到任何事件之前就緒
+        outbound.start()
+
+    async def close(self):
+        # 關閉 Ollama 共用連線池與 SQLite 連線
+        await close_session()
+        await super().close()
+        outbound.stop()
+        memory_ingestor.stop()
+        close_db()
+
+
+bot = LoverBot(command_prefix="%", intents=intents)
+dm_resolver = DMResolver(bot)
+# 所有對 Discord 的送出都經過這個佇列：互動回覆優先，大量通知在後，整體依令牌桶限流
+outbound = OutboundQueue()
+# 對話歷史存在 SQLite，記憶體只保留最近活躍的使用者
+history_store = HistoryStore(HISTORY_LIMIT)
+# 長期記憶在背景批次 embedding 並寫入向量庫，回覆流程不必等待
+memory_ingestor = MemoryIngestor(index_memories, load=get_unindexed_memory_ids)
+add_memory_listener(memory_ingestor.submit)
+
+
+async def send_dm(user_id: int, *args, **kwargs):
+    """私訊通知（大量 / 背景）"""
+    return await outbound.submit(
+        lambda: dm_resolver.send(user_id, *args, **kwargs),
+        PRIORITY_BULK,
+    )
+
+
+async def send_interactive(channel, *args, **kwargs):
+    """回覆使用者訊息（優先送出）"""
+    return await outbound.submit(
+        lambda: channel.send(*args, **kwargs),
+        PRIORITY_INTERACTIVE,
+    )
+
+
+async def edit_interactive(sent, **kwargs):
+    return await outbound.submit(
+        lambda: sent.edit(**kwargs),
+        PRIORITY_INTERACTIVE,
+    )
+
+
+async def send_dm_logged(label: str, user_id: int, *args, **kwargs):
+    try:
+        await send_dm(user_id, *args, **kwargs)
+    except Exception as e:
+        print(f"{label}:", e)
 
 # ======================
 # 啟動事件
@@ -66,14 +144,24 @@ def split_into_clauses(text: str):
 async def on_ready():
     init_db()
 
-    if not reminder_watcher.is_running():
-        reminder_watcher.start()
+    # 啟動時會重播尚未寫入向量庫的記憶，必須在資料庫升級之後
+    if not memory_ingestor.is_running():
+        memory_ingestor.start()
+
+    if not reminder_scheduler.is_running():
+        reminder_scheduler.start()
+
+    if not short_timer_engine.is_running():
+        short_timer_engine.start()
+
+    if not anniversary_dispatcher.is_running():
+        anniversary_dispatcher.start()
 
-    if not anniversary_watcher.is_running():
-        anniversary_watcher.start()
+    if not morning_summary_dispatcher.is_running():
+        morning_summary_dispatcher.start()
 
-    if not morning_summary_watcher.is_running():
-        morning_summary_watcher.start()
+    if not memory_consolidation_dispatcher.is_running():
+        memory_consolidation_dispatcher.start()
     try:
         synced = await bot.tree.sync()
         print(f"已同步 {len(synced)} 個斜線指令")
@@ -84,77 +172,147 @@ async def on_ready():
 # ======================
 # 排程監看器
 # ======================
-@tasks.loop(minutes=10)
-async def anniversary_watcher():
-    now_utc = datetime.utcnow()
-
-    anniversaries = get_all_anniversaries_with_tz() 
-    
-    from datetime import UTC 
-    now_utc = datetime.now(UTC) 
-    
-    for user_id, type_, month, day, label, tz in anniversaries:
+async def send_anniversaries(tz: str, local_date):
+    """
+    某時區到了當地 09:00：只讀出這個時區今天的紀念日並發送
+    """
+    date_key = local_date.isoformat()
+
+    async def send_one(anniversary_id, user_id, type_, label):
+        # 先在發送紀錄登記，重啟後補發時已送過的不會重複
+        if not claim_dispatch("anniversary", anniversary_id, date_key):
+            return
+        if type_ == "birthday":
+            text = f"今天是你的生日！生日快樂！🎉"
+        else:
+            text = f"今天是你的 {label}，別忘了慶祝喔！"
         try:
-            user_tz = ZoneInfo(tz)
-            local_now = now_utc.astimezone(user_tz)
-        except Exception:
-            continue
-
-        if local_now.month == month and local_now.day == day:
-            if local_now.hour == 9 and local_now.minute < 10:
-                try:
-                    user = await bot.fetch_user(user_id)
-                    if type_ == "birthday":
-                        await user.send(f"今天是你的生日！生日快樂！🎉")
-                    else:
-                        await user.send(f"今天是你的 {label}，別忘了慶祝喔！")
-                except Exception as e:
-                    print("紀念日提醒失敗:", e)
+            await send_dm(user_id, text)
+        except Exception as e:
+            print("紀念日提醒失敗:", e)
+            release_dispatch("anniversary", anniversary_id, date_key)
+
+    rows = get_anniversaries_on(tz, local_date.month, local_date.day)
+    await asyncio.gather(*(send_one(*row) for row in rows))
+
+# 依時區分組，在各時區當地 09:00 觸發；沒設定時區的使用者算在 Asia/Taipei
+anniversary_dispatcher = DailyZoneDispatcher(
+    9,
+    send_anniversaries,
+    lambda: set(get_user_timezones()) | {"Asia/Taipei"},
+    grace_minutes=10,
+    name="anniversary",
+)
 
-@tasks.loop(seconds=30)
-async def morning_summary_watcher():
-    now_utc = datetime.utcnow()
+async def send_morning_summaries(tz: str, local_date):
+    """
+    某時區到了當地 08:00：只查這個時區今天有行程的使用者並發送摘要
+    """
+    zone = ZoneInfo(tz)
+    day_start = datetime.combine(local_date, datetime.min.time(), tzinfo=zone)
+    start_iso = day_start.astimezone(ZoneInfo("UTC")).isoformat()
+    end_iso = (day_start + timedelta(days=1)).astimezone(ZoneInfo("UTC")).isoformat()
+    date_key = local_date.isoformat()
+
+    # 先在發送紀錄登記，重啟後補發時已送過的人會被略過
+    user_ids = [
+        user_id
+        for user_id in get_users_with_reminders_between(tz, start_iso, end_iso)
+        if claim_dispatch("morning_summary", user_id, date_key)
+    ]
+    if not user_ids:
+        return
 
-    from bot_core.memory_manager import get_all_users
+    # 早安摘要是已知的大量發送，先一次建立好所有私訊頻道
+    await dm_resolver.warm(user_ids)
 
-    users = get_all_users()
+    from bot_core.schedule_renderer import render_schedule_embed
 
-    for user_id, tz in users:
+    async def send_summary(user_id):
+        reminders = get_reminders_between(user_id, start_iso, end_iso)
+        embed = render_schedule_embed(
+            reminders,
+            get_user_role(user_id),
+            user_timezone=tz,
+            title="早安！今天的行程提醒"
+        )
         try:
-            local_now = now_utc.astimezone(ZoneInfo(tz))
-        except Exception:
-            continue
+            await send_dm(user_id, embed=embed)
+        except Exception as e:
+            print("早安提醒失敗:", e)
+            release_dispatch("morning_summary", user_id, date_key)
+
+    await asyncio.gather(*(send_summary(user_id) for user_id in user_ids))
+
+# 依時區分組，在各時區當地 08:00 觸發
+morning_summary_dispatcher = DailyZoneDispatcher(
+    8,
+    send_morning_summaries,
+    get_user_timezones,
+    grace_minutes=30,
+    name="morning_summary",
+)
 
-        if local_now.hour == 8 and local_now.minute < 30:
-            reminders = get_today_reminders(user_id)
-            if not reminders:
-                continue
+# ======================
+# 長期記憶整理
+# ======================
+# 每天凌晨 04:00（台北時間）合併相似的記憶，並限制每位使用者的記憶數量
+memory_consolidation_dispatcher = DailyZoneDispatcher(
+    4,
+    lambda tz, local_date: consolidate_all(),
+    lambda: {"Asia/Taipei"},
+    grace_minutes=60,
+    name="memory_consolidation",
+)
 
-            role = get_user_role(user_id)
+# 提醒投遞失敗的重試設定：30 秒、60 秒、120 秒… 最多 MAX 次
+REMINDER_RETRY_BASE_SECONDS = 30
+REMINDER_RETRY_MAX_SECONDS = 1800
+REMINDER_MAX_ATTEMPTS = 6
 
-            from bot_core.schedule_renderer import render_schedule_embed
-            embed = render_schedule_embed(
-                reminders,
-                role,
-                title="早安！今天的行程提醒"
-            )
-
-            try:
-                user = await bot.fetch_user(user_id)
-                await user.send(embed=embed)
-            except Exception as e:
-                print("早安提醒失敗:", e)
-@tasks.loop(seconds=20)
-async def reminder_watcher():
-    now_utc = datetime.utcnow().isoformat()
-    rows = pop_due_reminders(now_utc)
-
-    for _, user_id, remind_at, content in rows:
-        try:
-            user = await bot.fetch_user(user_id)
-            await user.send(f"提醒你：{content}")
-        except Exception as e:
-            print("提醒失敗:", e)
+async def deliver_reminder(reminder_id: int, user_id: int, content: str, attempts: int) -> bool:
+    """
+    送出一筆提醒；回傳 True 代表可以 ack（已送達或放棄重試）
+    """
+    try:
+        await send_dm(user_id, f"提醒你：{content}")
+        return True
+    except (discord.Forbidden, discord.NotFound) as e:
+        # 使用者關閉私訊或已不存在，重試也不會成功
+        print("提醒失敗（放棄）:", e)
+        return True
+    except Exception as e:
+        if attempts >= REMINDER_MAX_ATTEMPTS:
+            print(f"提醒失敗（已重試 {attempts} 次，放棄）:", e)
+            return True
+        delay = min(
+            REMINDER_RETRY_BASE_SECONDS * 2 ** (attempts - 1),
+            REMINDER_RETRY_MAX_SECONDS,
+        )
+        retry_at = datetime.now(ZoneInfo("UTC")) + timedelta(seconds=delay)
+        release_reminder(reminder_id, retry_at)
+        reminder_scheduler.schedule(retry_at.timestamp(), reminder_id)
+        print(f"提醒失敗，{delay} 秒後重試:", e)
+        return False
+
+async def deliver_due_reminders(_reminder_ids):
+    # 同一時間到期的提醒一次取走；heap 裡重複或已刪除的 id 不影響結果
+    rows = claim_due_reminders()
+    results = await asyncio.gather(*(
+        deliver_reminder(reminder_id, user_id, content, attempts)
+        for reminder_id, user_id, _, content, attempts in rows
+    ))
+    ack_reminders([row[0] for row, done in zip(rows, results) if done])
+
+# 依最早到期時間睡眠，新增更早的提醒時由 save_reminder 喚醒
+reminder_scheduler = DeadlineScheduler(
+    deliver_due_reminders,
+    load=get_pending_reminder_times,
+    name="reminder_scheduler",
+)
+add_reminder_listener(
+    lambda reminder_id, when: reminder_scheduler.schedule(when, reminder_id)
+)
 
 # ======================
 # 角色切換
@@ -173,8 +331,7 @@ async def role(interaction: discord.Interaction, 人格: app_commands.Choice[str
     set_user_role(interaction.user.id, 人格.value)
     
     user_id = interaction.user.id
-    if user_id in user_history:
-        user_history[user_id] = [] # 清空該使用者的歷史紀錄
+    history_store.reset(user_id) # 清空該使用者的歷史紀錄
         
     await interaction.response.send_message(
         f"✅ 已切換為 **{人格.name}**，並已重置對話記憶。",
@@ -233,17 +390,88 @@ async def week(interaction: discord.Interaction):
 
     await interaction.response.send_message(embed=embed, ephemeral=True)
 
+# ======================
+# 執行統計（僅限機器人擁有者）
+# ======================
+def format_stats(values: dict) -> str:
+    return "  ".join(
+        f"{key}={value:.3f}" if isinstance(value, float)
+        else f"{key}=({format_stats(value)})" if isinstance(value, dict)
+        else f"{key}={value}"
+        for key, value in values.items()
+    )
+
+@bot.tree.command(name="stats", description="查看機器人的執行統計")
+async def stats(interaction: discord.Interaction):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("只有機器人擁有者可以查看統計", ephemeral=True)
+        return
+
+    sections = {
+        "prompt": get_prompt_stats(),
+        "規則判斷": get_fast_path_stats(),
+        "設定快取": get_settings_cache_stats(),
+        "私訊頻道": dm_resolver.stats(),
+        "送出佇列": outbound.stats(),
+        "embedding 快取": get_embedding_cache_stats(),
+        "記憶寫入": memory_ingestor.stats(),
+        "記憶檢索": get_retrieval_stats(),
+        "對話歷史": history_store.stats(),
+    }
+    text = "\n".join(f"【{name}】{format_stats(values)}" for name, values in sections.items())
+    await interaction.response.send_message(
+        f"```\n{text[:DISCORD_MESSAGE_LIMIT - 8]}\n```",
+        ephemeral=True
+    )
 
 
-async def short_timer(bot, delay: int, content: str, user_id: int):
-    await asyncio.sleep(delay)
-    try:
-        user = await bot.fetch_user(user_id)
-        await user.send(f"（*輕輕拍了拍你*）提醒你：{content}")
-    except asyncio.CancelledError:
-        pass
-    except Exception as e:
-        print("短提醒執行失敗:", e)
+
+async def stream_reply(message, user_id: int, user_text: str, history: list) -> str:
+    """
+    一邊接收模型串流一邊編輯同一則 Discord 訊息，回傳完整回覆文字
+    """
+    prefix = f"{message.author.mention} "
+    loop = asyncio.get_running_loop()
+    sent = None
+    shown = ""
+    reply = ""
+    last_edit = 0.0
+
+    async for piece in stream_response(user_id, user_text, history):
+        reply += piece
+        if not reply.strip():
+            continue
+
+        text = (prefix + reply)[:DISCORD_MESSAGE_LIMIT]
+        if sent is None:
+            sent = await send_interactive(message.channel, text)
+            shown, last_edit = text, loop.time()
+        elif loop.time() - last_edit >= STREAM_EDIT_INTERVAL and text != shown:
+            await edit_interactive(sent, content=text)
+            shown, last_edit = text, loop.time()
+
+    text = (prefix + reply)[:DISCORD_MESSAGE_LIMIT]
+    if sent is None:
+        await send_interactive(message.channel, text)
+    elif text != shown:
+        await edit_interactive(sent, content=text)
+
+    return reply
+
+
+async def short_timer(reminder_ids):
+    # 已取消的短提醒在資料庫裡已被刪除，這裡自然會被略過
+    await asyncio.gather(*(
+        send_dm_logged("短提醒執行失敗", user_id, f"（*輕輕拍了拍你*）提醒你：{content}")
+        for _, user_id, content in pop_short_reminders(reminder_ids)
+    ))
+
+# 所有短提醒共用一個 heap 與一個迴圈；資料存在 short_reminders，重啟後自動重新排程
+short_timer_engine = DeadlineScheduler(
+    short_timer,
+    load=get_pending_short_reminder_times,
+    name="short_timer_engine",
+)
 
 # ======================
 # 時間解析
@@ -416,29 +644,26 @@ async def on_message(message):
     
     tz = get_user_timezone(user_id) or "Asia/Taipei"
 
-    delete_intent = parse_delete_intent(original_text)
-    is_delete = "刪除" in original_text
-    delete_intent = parse_delete_intent(original_text) if is_delete else None
+    # 一次呼叫取得刪除 / 短提醒 / 記憶判斷，下方各分支共用
+    intents = await extract_message_intents(original_text)
+
+    # 「取消…」只有在被判定為刪除意圖時才進入刪除流程，避免一般聊天誤觸
+    is_delete = "刪除" in original_text or intents["delete"] is not None
+    delete_intent = intents["delete"]
 
     if is_delete:
         delete_intent = delete_intent or {}
         time_hint = delete_intent.get("time_hint")
         content_hint = delete_intent.get("content_hint")
 
-        tasks = short_reminder_tasks.get(user_id, [])
-        for t in list(tasks): 
-            if content_hint and content_hint in t["content"]:
-                t["task"].cancel()
-                tasks.remove(t)
-
-                if not tasks:
-                    short_reminder_tasks.pop(user_id, None)
+        cancelled = cancel_short_reminder(user_id, content_hint) if content_hint else None
+        if cancelled:
+            await send_interactive(
+                message.channel,
+                f"{message.author.mention} 🗑️ 已幫你取消短時間提醒：{cancelled}"
+            )
+            return
 
-                await message.channel.send(
-                    f"{message.author.mention} 🗑️ 已幫你取消短時間提醒：{t['content']}"
-                )
-                return
-            
 
         reminders = get_reminders(user_id)
         candidates = []
@@ -500,7 +725,8 @@ async def on_message(message):
 
 
         if not candidates:
-            await message.channel.send(
+            await send_interactive(
+                message.channel,
                 f"{message.author.mention} ⚠️ 我找不到符合描述的提醒，可以再說清楚一點嗎？"
             )
             return
@@ -510,30 +736,20 @@ async def on_message(message):
 
         delete_reminder_by_index(user_id, index)
 
-        await message.channel.send(
+        await send_interactive(
+            message.channel,
             f"{message.author.mention} 🗑️ 已幫你刪除這個行程：\n"
             f"🕒 {remind_at.replace('T',' ')[:16]}｜{content}"
         )
         return
-    clauses = split_into_clauses(original_text)
     confirmations = []
 
-    for clause in clauses:
-        intent = parse_reminder_intent(clause)
-        if not intent:
-            continue
-
+    for intent in intents["reminders"]:
         delay = intent["delay_seconds"]
         content = intent["content"]
 
-        task = asyncio.create_task(
-            short_timer(bot, delay, content, user_id)
-        )
-
-        short_reminder_tasks.setdefault(user_id, []).append({
-            "content": content,
-            "task": task
-        })
+        reminder_id, fire_at = save_short_reminder(user_id, delay, content)
+        short_timer_engine.schedule(fire_at, reminder_id)
 
         confirmations.append(f"{delay} 秒後：{content}")
 
@@ -549,7 +765,8 @@ async def on_message(message):
         remind_at, content = parsed
         save_reminder(user_id, remind_at, content)
 
-        await message.channel.send(
+        await send_interactive(
+            message.channel,
             f"{message.author.mention} ✅ 已幫你記下行程：\n"
             f"🕒 {remind_at.replace('T',' ')[:16]}｜{content}"
         )
@@ -566,31 +783,14 @@ async def on_message(message):
         role = get_user_role(user_id)
         tz = get_user_timezone(user_id) or "Asia/Taipei"
         reply = render_schedule(reminders, role, tz)
-        await message.channel.send(f"{message.author.mention} {reply}")
+        await send_interactive(message.channel, f"{message.author.mention} {reply}")
         return
 
-    result = should_store_memory(original_text)
+    result = intents["memory"]
     if result and result.get("store"):
-        save_memory(user_id, result["category"], result["content"])
-
-    if user_id not in user_history:
-        user_history[user_id] = []
-
-    loop = asyncio.get_running_loop()
-    reply = await loop.run_in_executor(
-        None,
-        generate_response,
-        user_id,
-        user_text,
-        user_history[user_id]
-    )
-    
-    user_history[user_id].append({"role": "user", "content": original_text})
-    user_history[user_id].append({"role": "assistant", "content": reply})
-    
-    if len(user_history[user_id]) > 10:
-        user_history[user_id] = user_history[user_id][-10:]
+        save_memory(user_id, result["category"], result["content"], result.get("importance", 1))
 
-    await message.channel.send(f"{message.author.mention} {reply}")
+    reply = await stream_reply(message, user_id, user_text, history_store.get(user_id))
+    history_store.append(user_id, original_text, reply)
 
 bot.run(TOKEN)
\ No newline at end of file
@@ -0,0 +1,46 @@
+import pytest
+
+from bot_core.intent_rules import match_delete, pre_classify
+
+
+def _delays(text):
+    result = pre_classify(text)
+    if result is None:
+        return None
+    return [r["delay_seconds"] for r in result["reminders"]]
+
+
+@pytest.mark.parametrize("text, delays", [
+    ("10分鐘後提醒我喝水", [600]),
+    ("半小時後記得提醒我去運動", [1800]),
+    ("提醒我三分鐘後關火", [180]),
+    ("一個半小時後提醒我吃藥", [5400]),
+    ("2個半小時後提醒我收衣服", [9000]),
+    ("0.5小時後提醒我喝水", [1800]),
+    ("今天好累喔", []),
+])
+def test_short_reminder_delay(text, delays):
+    assert _delays(text) == delays
+
+
+@pytest.mark.parametrize("text", [
+    "1小時30分鐘後提醒我出門",
+    "一百二十分鐘後提醒我關火",
+    "一小時半後提醒我吃藥",
+    "兩天3小時後提醒我繳費",
+])
+def test_compound_duration_goes_to_llm(text):
+    assert pre_classify(text) is None
+
+
+@pytest.mark.parametrize("text, content_hint", [
+    ("刪除明天下午3點的會議", "會議"),
+    ("幫我取消喝水的提醒", "喝水"),
+])
+def test_match_delete(text, content_hint):
+    assert match_delete(text)["content_hint"] == content_hint
+
+
+@pytest.mark.parametrize("text", ["活動取消了", "我取消了約會"])
+def test_delete_statement_goes_to_llm(text):
+    assert pre_classify(text) is None